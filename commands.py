@@ -1,373 +1,426 @@
-class Command:
+import struct
+from collections import Counter
+
+
+class Layout:
+    # Fixed width fields of a command, decoded with a single precompiled Struct
+    # fields are (name, code) pairs, e.g. ("techId", "I") or ("mTerrainPoint", "3I") for a posVector
+
+    def __init__(self, fields):
+        self.fields = tuple(fields)
+        fmt = "<"
+        self.names = []
+        self.groups = []
+        i = 0
+        for name, code in self.fields:
+            fmt += code
+            count = int(code[:-1]) if len(code) > 1 else 1
+            self.names.append(name)
+            # Multi value fields come out as a list like read_posVector gives
+            self.groups.append((name, i, i + count if len(code) > 1 else None))
+            i += count
+        self.is_flat = all(end is None for name, start, end in self.groups)
+        self.struct = struct.Struct(fmt)
+        self.size = self.struct.size
+
+    def read(self, obj, reader):
+        values = reader.read_struct(self.struct)
+        if self.is_flat:
+            for name, value in zip(self.names, values):
+                setattr(obj, name, value)
+        else:
+            for name, start, end in self.groups:
+                if end is None:
+                    setattr(obj, name, values[start])
+                else:
+                    setattr(obj, name, list(values[start:end]))
+
+# Fixed parts of the header shared by every command. The variable length lists sit between them
+HEADER_START = struct.Struct("<BIIIII") # num, playerId, field_28, mAIID, field_30, field_34_len
+RECIPIENTS_START = struct.Struct("<II") # field_48, mRecipientsLen
+HEADER_END = (("field_8c", "I"), ("field_90", "I"), ("field_94", "I"),
+              ("mUrgencyCount", "B"), ("mEventId", "I"), ("mPlanId", "I"))
+
+class CommandType(type):
+    # Compiles each command class's LAYOUT and gives the class __slots__ for those fields, so they are stored
+    # without a dict. Command also has a __dict__ slot, so a decoder that sets other attributes in read() (or
+    # anyone setting one on a command) still works. The dict is only made when that happens
+    def __new__(mcs, name, bases, namespace):
+        own_layout = namespace.get("LAYOUT", ())
+        namespace["__slots__"] = tuple(field for field, code in own_layout) + tuple(namespace.get("__slots__", ()))
+        cls = super().__new__(mcs, name, bases, namespace)
+        cls.layout = Layout(HEADER_END + cls.LAYOUT)
+        return cls
+
+class Command(metaclass=CommandType):
     #mRecipients seems to be unitid of units that are processed by command
     # field 34 maybe player ids
 
+    __slots__ = ("num", "playerId", "field_28", "mAIID", "field_30", "field_34_len", "field_34",
+                 "field_48", "mRecipientsLen", "mRecipients", "waypointsLen", "waypoints", "mFlags",
+                 "field_8c", "field_90", "field_94", "mUrgencyCount", "mEventId", "mPlanId", "__dict__")
+
+    # Fields following the header. Each subclass declares its own and they are read in one go with the header end
+    LAYOUT = ()
+
     def __init__(self):
         self.mRecipients = []
 
     def read(self,reader):
-        self.num = reader.read_one()
-        self.playerId = reader.read_four()
-
-        self.field_28 = reader.read_four()
+        (self.num, self.playerId, self.field_28, self.mAIID, self.field_30,
+         self.field_34_len) = reader.read_struct(HEADER_START)
+        self.field_34 = reader.read_u32_array(self.field_34_len)
 
-        self.mAIID = reader.read_four()
-        
-        self.field_30 = reader.read_four()
-
-        self.field_34_len = reader.read_four()
-        for i in range(self.field_34_len):
-            reader.read_four()
-
-        self.field_48 = reader.read_four()
-
-        self.mRecipientsLen = reader.read_four()
-        for i in range(self.mRecipientsLen):
-            self.mRecipients.append(reader.read_four())
+        self.field_48, self.mRecipientsLen = reader.read_struct(RECIPIENTS_START)
+        self.mRecipients = list(reader.read_u32_array(self.mRecipientsLen))
         
         self.waypointsLen = reader.read_four()
-        self.waypoints = []
-        for i in range(self.waypointsLen):
-            x = reader.read_float()
-            y = reader.read_float()
-            z = reader.read_float()
-            self.waypoints.append((x,y,z))
+        coords = reader.read_f32_array(3 * self.waypointsLen)
+        self.waypoints = list(zip(coords[0::3], coords[1::3], coords[2::3]))
 
         # read mFlags  
         mFlagsSize = reader.read_four()
-        reader.read_n(mFlagsSize)
-
-        self.field_8c = reader.read_four()
-        self.field_90 = reader.read_four()
-        self.field_94 = reader.read_four()
-        self.mUrgencyCount = reader.read_one()
-        self.mEventId = reader.read_four()
-        self.mPlanId = reader.read_four()
-
-    def get_command(commandNum):
-        map = {0: WorkCommand, 1: ResearchCommand, 2 : TrainCommand, 3: BuildCommand, 
-               4: SetGatherPointCommand, 5: None, 6: CreateUnitCommand, 7: DeleteUnitCommand,
-               8: None, 9: AddResourceCommand, 0xa: StopCommand, 0xb: None, 0xc: None,
-               0xd: None, 0xe: None, 0xf: PauseCommand, 0x10: SpecialPowerCommand, 
-               0x11: MarketCommand, 0x12: EjectCommand, 0x13: None,
-               0x14: ResignCommand, 0x15: None, 0x16: EnterCommand, 0x17: TributeCommand,
-               0x18: None, 0x19: None, 0x1a: None, 0x1b: None, 0x1c: TransformCommand,
-               0x1d: None, 0x1e: None, 0x1f: None, 0x20: UnitTeleportCommand, 0x21: StanceCommand,
-               0x22: None, 0x23: None, 0x24: None, 0x25: None, 0x26: None, 0x27: None,
-               0x28: None, 0x29: None, 0x2a: TownBellCommand, 0x2b: ExploreCommand,
-               0x2c: None, 0x2d: AdjustArmyCommand, 0x2e: RepairCommand, 0x2f: EmpowerCommand,
-               0x30: None, 0x31: AiChatCommand, 0x32: PlayerDataCommand, 
-               0x33: FormationCommand, 0x34: GameCheatCommand, 0x35: UnbuildCommand, 0x36: AutoqueueCommand,
-               0x37: PlayerAutoGatherModeCommand, 0x38: PlayerSpeedUpConstructionCommand, 0x39: PlayerDisconnectCommand}
-        if commandNum not in map:
-            print(f"Cannot find command in map. Probably wrong num " + hex(commandNum))
-            return None
-        if map[commandNum] is None:
-            print("Command " + hex(commandNum) + " not implemented")
-            return None
-        return map[commandNum]()
+        self.mFlags = reader.read_n(mFlagsSize)
+
+        # field_8c through mPlanId, then the fields of the subclass
+        self.layout.read(self, reader)
+
+    @classmethod
+    def skip(cls, reader):
+        # Moves reader past a command of this type without decoding it
+        if cls.read is not Command.read:
+            # A read() of its own can read more than LAYOUT says, so the size is only known by reading it
+            cls().read(reader)
+            return
+        cls.skip_fields(reader)
+
+    @classmethod
+    def skip_fields(cls, reader):
+        # Skips the header and LAYOUT. Only the lengths of the variable length lists are read
+        reader.skip(HEADER_START.size - 4)
+        n = reader.read_four() # field_34_len
+        reader.skip(4 * n + 4)
+        n = reader.read_four() # mRecipientsLen
+        reader.skip(4 * n)
+        n = reader.read_four() # waypointsLen
+        reader.skip(12 * n)
+        n = reader.read_four() # mFlags size
+        reader.skip(n + cls.layout.size)
+
+    def get_command(commandNum, variant=None):
+        return registry.create(commandNum, variant)
 
 class GameCheatCommand(Command):
+    LAYOUT = (("d1", "I"), ("d2", "I"))
+
     def __init__(self):
         super().__init__()
-    
-    def read(self, reader):
-        super().read(reader)
-        self.d1 = reader.read_four()
-        self.d2 = reader.read_four()
 class UnitTeleportCommand(Command):
+    LAYOUT = (("d1", "3I"),)
+
     def __init__(self):
         super().__init__()
-    
-    def read(self, reader):
-        super().read(reader)
-        self.d1 = reader.read_posVector()
 
 class PlayerSpeedUpConstructionCommand(Command):
     def __init__(self):
         super().__init__()
-    
-    def read(self, reader):
-        super().read(reader)
 class PlayerAutoGatherModeCommand(Command):
+    LAYOUT = (("d1", "I"),)
+
     def __init__(self):
         super().__init__()
-    
-    def read(self, reader):
-        super().read(reader)
-        self.d1 = reader.read_four()
 
 class EmpowerCommand(Command):
+    LAYOUT = (("d1", "I"),)
+
     def __init__(self):
         super().__init__()
-    
-    def read(self, reader):
-        super().read(reader)
-        self.d1 = reader.read_four()
 
 class EjectCommand(Command):
+    LAYOUT = (("d1", "I"),)
+
     def __init__(self):
         super().__init__()
     
-    def read(self, reader):
-        super().read(reader)
-        self.d1 = reader.read_four()
-    
 class UnbuildCommand(Command):
+    LAYOUT = (("d1", "3I"), ("d2", "3I"))
+
     def __init__(self):
         super().__init__()
-    
-    def read(self, reader):
-        super().read(reader)
-        self.d1 = reader.read_posVector()
-        self.d2 = reader.read_posVector()
 
 class PauseCommand(Command): 
+    LAYOUT = (("d1", "B"),)
+
     def __init__(self):
         raise NotImplementedError("Check needed")
 
-    def read(self, reader):
-        super().read(reader)
-        self.d1 = reader.read_one()
+    @classmethod
+    def skip(cls, reader):
+        raise NotImplementedError("Check needed")
 
 class AddResourceCommand(Command): 
+    LAYOUT = (("d1", "I"), ("d2", "I"))
+
     def __init__(self):
         raise NotImplementedError("Check needed")
-        
-    def read(self, reader):
-        super().read(reader)
-        self.d1 = reader.read_four()
-        self.d2 = reader.read_four()
+
+    @classmethod
+    def skip(cls, reader):
+        raise NotImplementedError("Check needed")
 
 class CreateUnitCommand(Command):
+    __slots__ = ("name",)
+    LAYOUT = (("protoId", "I"), ("heading", "3I"), ("pos", "3I"), ("nameLen", "I"), ("blkSize", "I"))
+
     def __init__(self):
         super().__init__()
 
     def read(self, reader):
         super().read(reader)
-        self.protoId = reader.read_four()
-        self.heading = reader.read_posVector()
-        self.pos = reader.read_posVector()
-        self.nameLen = reader.read_four()
-        blkSize = reader.read_four()
         self.name = reader.read_n(self.nameLen)
 
 class FormationCommand(Command):
+    LAYOUT = (("formation", "B"),)
+
     def __init__(self):
         super().__init__()
 
-    def read(self, reader):
-        super().read(reader)
-        self.formation = reader.read_one()
-
 class RepairCommand(Command):
+    LAYOUT = (("d1", "I"),)
+
     def __init__(self):
         super().__init__()
 
-    def read(self, reader):
-        super().read(reader)
-        self.d1 = reader.read_four()
-
 class TownBellCommand(Command):
     def __init__(self):
         super().__init__()
 
-    def read(self, reader):
-        super().read(reader)
-
 class PlayerDataCommand(Command):
+    LAYOUT = (("d1", "I"),)
+
     def __init__(self):
         super().__init__()
 
-    def read(self, reader):
-        super().read(reader)
-        reader.read_four()
-
 class MarketCommand(Command):
+    LAYOUT = (("res", "I"), ("field_b0", "I"), ("amt", "I"))
+
     def __init__(self):
         super().__init__()
-
-    def read(self, reader):
-        super().read(reader)
-        self.res = reader.read_four()
-        self.field_b0 = reader.read_four()
-        self.amt = reader.read_four()
     
 class TributeCommand(Command):
+    LAYOUT = (("res", "I"), ("to", "I"), ("amt", "I"), ("field_b8", "I"))
+
     def __init__(self):
         super().__init__()
 
-    def read(self, reader):
-        super().read(reader)
-        self.res = reader.read_four()
-        self.to = reader.read_four()
-        self.amt = reader.read_four()
-        self.field_b8 = reader.read_four()
-
 class TransformCommand(Command):
+    LAYOUT = (("d1", "I"), ("d2", "B"))
+
     def __init__(self):
         super().__init__()
 
-    def read(self, reader):
-        super().read(reader)
-        reader.read_four()
-        reader.read_one()
-
 class EnterCommand(Command):
+    LAYOUT = (("d1", "I"),)
+
     def __init__(self):
         super().__init__()
 
-    def read(self, reader):
-        super().read(reader)
-        self.d1 = reader.read_four()
-
 class AdjustArmyCommand(Command):
+    LAYOUT = (("d1", "B"), ("d2", "I"))
+
     def __init__(self):
         super().__init__()
 
-    def read(self, reader):
-        super().read(reader)
-
-        self.d1 = reader.read_one()
-        self.d2 = reader.read_four()
-
 class PlayerDisconnectCommand(Command):
+    __slots__ = ("ac",)
+
     def __init__(self):
         super().__init__()
 
     def read(self, reader):
-        # print("BEFORE = " + hex(reader.seek))
+        # ac comes before the usual header
         self.ac = reader.read_four()
         super().read(reader)
 
+    @classmethod
+    def skip(cls, reader):
+        reader.skip(4)
+        cls.skip_fields(reader)
+
 class SpecialPowerCommand(Command):
+    LAYOUT = (("d1", "I"), ("d2", "3I"), ("d3", "3I"), ("d4", "I"))
+
     def __init__(self):
         super().__init__()
 
-    def read(self, reader):
-        super().read(reader)
-        self.d1 = reader.read_four()
-        self.d2 = reader.read_posVector()
-        self.d3 = reader.read_posVector()
-        self.d4 = reader.read_four()
-
 class ResearchCommand(Command):
+    LAYOUT = (("techId", "I"), ("field_b0", "I"))
+
     def __init__(self):
         super().__init__()
 
-    def read(self, reader):
-        super().read(reader)
-        self.techId = reader.read_four()
-        self.field_b0 = reader.read_four()
-
 
 class AiChatCommand(Command):
+    LAYOUT = (("d1", "I"), ("d2", "I"), ("d3", "I"),
+              ("d4", "I"), ("d5", "I"), ("d6", "I"), ("d7", "I"), ("d8", "3I"))
+
     def __init__(self):
         super().__init__()
 
-    def read(self, reader):
-        super().read(reader)
-        reader.read_four()
-        reader.read_four()
-        reader.read_four()
-
-        reader.read_four()
-        reader.read_four()
-        reader.read_four()
-        reader.read_four()
-        reader.read_posVector()
-
 class DeleteUnitCommand(Command):
+    LAYOUT = (("d1", "B"),)
+
     def __init__(self):
         super().__init__()
 
-    def read(self, reader):
-        super().read(reader)
-        self.d1 = reader.read_one()
-
 class ResignCommand(Command):
+    # d2 is maybe left in team, d3 maybe playerCount
+    LAYOUT = (("resigningPlayerId", "I"), ("d2", "I"), ("d3", "I"))
+
     def __init__(self):
         super().__init__()
-
-    def read(self, reader):
-        super().read(reader)
-        self.resigningPlayerId = reader.read_four()
-        self.d2 = reader.read_four() #maybe left in team
-        self.d3 = reader.read_four() #maybe playerCount
         
 class BuildCommand(Command):
+    LAYOUT = (("protoUnitId", "I"), ("mBuildingPosition", "3I"), ("d3", "3I"),
+              ("resId", "I"), ("field_cc", "I"))
+
     def __init__(self):
         super().__init__()
 
-    def read(self, reader):
-        super().read(reader)
-        self.protoUnitId = reader.read_four()
-        self.mBuildingPosition = reader.read_posVector()
-
-        self.d3 = reader.read_posVector()
-
-        self.resId = reader.read_four()
-        self.field_cc = reader.read_four()
-
 class WorkCommand(Command):
     # Potentially a group of units (mRecipients) does work on a unit
+    LAYOUT = (("mUnitId", "I"), ("mRange", "I"), ("mTerrainPoint", "3I"))
 
     def __init__(self):
         super().__init__()
-
-    def read(self, reader):
-        super().read(reader)
-        self.mUnitId = reader.read_four()
-
-        self.mRange = reader.read_four()
-
-        self.mTerrainPoint = reader.read_posVector()
     
 class AutoqueueCommand(Command):
     def __init__(self):
         super().__init__()
 
 class ExploreCommand(Command):
+    LAYOUT = (("some", "I"),)
+
     def __init__(self):
         super().__init__()
 
-    def read(self, reader):
-        super().read(reader)
-        self.some = reader.read_four()
-
 class SetGatherPointCommand(Command):
+    LAYOUT = (("d1", "I"), ("d2", "I"), ("d3", "I"), ("d4", "I"), ("d5", "I"))
+
     def __init__(self):
         super().__init__()
 
-    def read(self, reader):
-        super().read(reader)
-        self.d1 = reader.read_four()
-        self.d2 = reader.read_four()
-        self.d3 = reader.read_four()
-
-        self.d4 = reader.read_four()
-        self.d5 = reader.read_four()
-
         
 class StanceCommand(Command):
+    LAYOUT = (("probStance", "B"),)
+
     def __init__(self):
         super().__init__()
 
-    def read(self, reader):
-        super().read(reader)
-        self.probStance = reader.read_one()
-
 class StopCommand(Command):
     def __init__(self):
         super().__init__()
 
 class TrainCommand(Command):
+    LAYOUT = (("mProtoUnitId", "I"), ("mAction", "I"), ("mArmyId", "I"))
+
     def __init__(self):
         super().__init__()
 
-    def read(self, reader):
-        super().read(reader)
-        self.mProtoUnitId = reader.read_four()
-        self.mAction = reader.read_four()
-        self.mArmyId = reader.read_four()
 
+VARIANT_EE = "ee"
+VARIANT_AOT = "aot"
+
+class CommandRegistry:
+    # Maps command numbers to Command classes. Entries can be shared or only apply to one game variant
+    # Known numbers we can't decode yet map to None
+
+    def __init__(self):
+        self.common = {}
+        self.variants = {VARIANT_EE: {}, VARIANT_AOT: {}}
+        self.tables = {}
+        # Counted instead of printed since lookups happen for every command
+        self.unknown = Counter()
+        self.unimplemented = Counter()
+        self.rebuild()
+
+    def register(self, commandNum, cls, variant=None):
+        self.register_many({commandNum: cls}, variant)
+
+    def register_many(self, commands, variant=None):
+        if variant is None:
+            self.common.update(commands)
+        else:
+            self.variants[variant].update(commands)
+        self.rebuild()
+
+    def rebuild(self):
+        # Merged lookup table per variant. None is used when the variant isn't known
+        self.tables = {None: dict(self.common)}
+        for variant, overrides in self.variants.items():
+            table = dict(self.common)
+            table.update(overrides)
+            self.tables[variant] = table
+        # And back from class to number
+        self.numbers = {}
+        for variant, table in self.tables.items():
+            self.numbers[variant] = {cls: commandNum for commandNum, cls in sorted(table.items(), reverse=True) if cls is not None}
+
+    def lookup(self, commandNum, variant=None):
+        table = self.tables[variant]
+        cls = table.get(commandNum)
+        if cls is None:
+            if commandNum in table:
+                self.unimplemented[commandNum] += 1
+            else:
+                self.unknown[commandNum] += 1
+        return cls
+
+    def number(self, cls, variant=None):
+        # Command number cls is registered under, -1 if it isn't
+        return self.numbers[variant].get(cls, -1)
+
+    def create(self, commandNum, variant=None):
+        cls = self.lookup(commandNum, variant)
+        if cls is None:
+            return None
+        return cls()
+
+    def decode(self, reader, commandNum, variant=None):
+        # Returns the command read from reader, or None if we can't decode commandNum
+        cls = self.lookup(commandNum, variant)
+        if cls is None:
+            return None
+        cmd = cls()
+        cmd.read(reader)
+        return cmd
+
+    def skip(self, reader, commandNum, variant=None):
+        # Moves reader past the command without creating it. Returns False if we can't decode commandNum
+        cls = self.lookup(commandNum, variant)
+        if cls is None:
+            return False
+        cls.skip(reader)
+        return True
+
+COMMANDS = {0: WorkCommand, 1: ResearchCommand, 2 : TrainCommand, 3: BuildCommand, 
+               4: SetGatherPointCommand, 5: None, 6: CreateUnitCommand, 7: DeleteUnitCommand,
+               8: None, 9: AddResourceCommand, 0xa: StopCommand, 0xb: None, 0xc: None,
+               0xd: None, 0xe: None, 0xf: PauseCommand, 0x10: SpecialPowerCommand, 
+               0x11: MarketCommand, 0x12: EjectCommand, 0x13: None,
+               0x14: ResignCommand, 0x15: None, 0x16: EnterCommand, 0x17: TributeCommand,
+               0x18: None, 0x19: None, 0x1a: None, 0x1b: None, 0x1c: TransformCommand,
+               0x1d: None, 0x1e: None, 0x1f: None, 0x20: UnitTeleportCommand, 0x21: StanceCommand,
+               0x22: None, 0x23: None, 0x24: None, 0x25: None, 0x26: None, 0x27: None,
+               0x28: None, 0x29: None, 0x2a: TownBellCommand, 0x2b: ExploreCommand,
+               0x2c: None, 0x2d: AdjustArmyCommand, 0x2e: RepairCommand, 0x2f: EmpowerCommand,
+               0x30: None, 0x31: AiChatCommand, 0x32: PlayerDataCommand, 
+               0x33: FormationCommand, 0x34: GameCheatCommand, 0x35: UnbuildCommand, 0x36: AutoqueueCommand,
+               0x37: PlayerAutoGatherModeCommand, 0x38: PlayerSpeedUpConstructionCommand, 0x39: PlayerDisconnectCommand}
+
+registry = CommandRegistry()
+registry.register_many(COMMANDS)
+
+def register_command(commandNum, cls, variant=None):
+    # e.g. register_command(0x13, MyCommand, VARIANT_AOT) to decode a type that isn't implemented here
+    registry.register(commandNum, cls, variant)
@@ -0,0 +1,120 @@
+import struct
+
+# Precompiled layouts for the primitives. unpack_from reads in place, so no slice is made per value
+U8 = struct.Struct("<B")
+U16 = struct.Struct("<H")
+U32 = struct.Struct("<I")
+S32 = struct.Struct("<i")
+F32 = struct.Struct("<f")
+VEC3 = struct.Struct("<3f")
+POS_VECTOR = struct.Struct("<3I")
+
+unpack_u16 = U16.unpack_from
+unpack_u32 = U32.unpack_from
+unpack_s32 = S32.unpack_from
+unpack_f32 = F32.unpack_from
+unpack_vec3 = VEC3.unpack_from
+unpack_pos_vector = POS_VECTOR.unpack_from
+
+# Start of a sync entry: first byte, a second byte and a u16. Then a u32 unless the low nibble of
+# the first byte is 5, then two more u32s
+SYNC_ENTRY_START = struct.Struct("<BBH")
+SYNC_ENTRY_END = struct.Struct("<II")
+
+_array_structs = {}
+
+def sync_entries_end(data, pos, n, entries=None):
+    # Returns where the n sync entries starting at pos end. Only the first byte of each is looked at
+    # If entries is an array, six values are appended per entry, 0 for the u32 that isn't there
+    if entries is None:
+        for i in range(n):
+            pos += 12 if data[pos] & 0xf == 0x5 else 16
+        return pos
+    for i in range(n):
+        first, second, third = SYNC_ENTRY_START.unpack_from(data, pos)
+        if first & 0xf == 0x5:
+            extra = 0
+            pos += 4
+        else:
+            extra = unpack_u32(data, pos + 4)[0]
+            pos += 8
+        entries.extend((first, second, third, extra) + SYNC_ENTRY_END.unpack_from(data, pos))
+        pos += 8
+    return pos
+
+def array_struct(fmt, n):
+    # Cached Struct for n values of type fmt, e.g. array_struct("I", 3) is "<3I"
+    key = (fmt, n)
+    st = _array_structs.get(key)
+    if st is None:
+        st = struct.Struct("<" + str(n) + fmt)
+        _array_structs[key] = st
+    return st
+
+class Cursor:
+    # Reads little endian values out of self.decomp starting at self.seek
+    # self.view is a memoryview of the same data, used to hand out slices without copying
+    decomp = b""
+    view = memoryview(b"")
+    seek = 0
+
+    def set_data(self, decomp):
+        self.decomp = decomp
+        self.view = memoryview(decomp)
+
+    def read_four(self):
+        data = unpack_u32(self.decomp, self.seek)[0]
+        self.seek += 4
+        return data
+    def read_float(self):
+        data = unpack_f32(self.decomp, self.seek)[0]
+        self.seek += 4
+        return data
+
+    def read_one(self):
+        data = self.decomp[self.seek]
+        self.seek += 1
+        return data
+    def read_two(self):
+        data = unpack_u16(self.decomp, self.seek)[0]
+        self.seek += 2
+        return data
+    def read_n(self, n, copy=True):
+        # copy=False returns a memoryview into the data instead of a new bytes object
+        if copy:
+            data = self.decomp[self.seek:self.seek+n]
+        else:
+            data = self.view[self.seek:self.seek+n]
+        self.seek += n
+        return data
+    def read_four_s(self):
+        data = unpack_s32(self.decomp, self.seek)[0]
+        self.seek += 4
+        return data
+
+    def read_struct(self, st):
+        data = st.unpack_from(self.decomp, self.seek)
+        self.seek += st.size
+        return data
+    def read_u32_array(self, n):
+        if n == 0:
+            return ()
+        return self.read_struct(array_struct("I", n))
+    def read_f32_array(self, n):
+        if n == 0:
+            return ()
+        return self.read_struct(array_struct("f", n))
+    def read_vec3(self):
+        data = unpack_vec3(self.decomp, self.seek)
+        self.seek += 12
+        return data
+    def read_posVector(self):
+        data = unpack_pos_vector(self.decomp, self.seek)
+        self.seek += 12
+        return list(data)
+
+    def skip(self, n):
+        self.seek += n
+
+    def skip_sync_entries(self, n, entries=None):
+        self.seek = sync_entries_end(self.decomp, self.seek, n, entries)
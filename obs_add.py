@@ -2,9 +2,15 @@ import zlib
 import struct
 import os
 import argparse
+import glob
+import json
+import time
 import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import commands as Commands
+from cursor import Cursor, U8, U16, U32, S32
+import pzlib
 
 LOAD_FLAGS_TIME = 0x1
 LOAD_FLAGS_CAMERA1 = 0x2
@@ -16,9 +22,15 @@ LOAD_FLAGS_COMMANDS_MANY = 0x40
 LOAD_FLAGS_SELECTED_UNITS = 0x80
 
 
-class ObsAdd:
+OUTPUT_SUFFIX = "_obs.rcx"
+
+def output_path(filepath):
+    return filepath[:-4] + OUTPUT_SUFFIX
+
+class ObsAdd(Cursor):
     
-    def __init__(self, filepath, is_ee, observer_name):
+    def __init__(self, filepath, is_ee, observer_name, level=-1, threads=None):
+        # level and threads are for compressing the output, threads defaults to the number of cores
         with open(filepath, "rb") as f:
             all = f.read()
         
@@ -39,99 +51,76 @@ class ObsAdd:
         # Sanity check size
         if size != len(decomp):
             raise ValueError("Error in decompression. File might be corrupted")
-        self.decomp = decomp
+        self.set_data(decomp)
         
         self.seek = 1474 if is_ee else 1466
-        self.outpath = filepath[:-4] + "_obs.rcx"
+        self.outpath = output_path(filepath)
         # self.outpath = "rcxs/test.rcx"
         self.footer = decomper.unused_data
         
-        self.out_str = b""
-        self.write_data(self.decomp[:self.seek])
+        # The rewritten recording, it only grows so a bytearray avoids copying it on every write
+        self.out = bytearray()
+        self.span_start = 0
 
         last_sixteen = all[-16:]
         uncompressed_seek = struct.unpack("<I", last_sixteen[8:12])[0]
 
         self.is_ee = is_ee
         self.observer_name = observer_name
-
-    def skip(self, n):
-        self.seek += n
+        self.level = level
+        self.threads = threads
 
     def read_section(self, totalSize):
-        read = b""
+        # Blocks are gathered as views and joined once at the end
+        blocks = []
         while totalSize > 0:
             blockSize = self.read_four()
             if blockSize == 0:
                 raise ValueError("Zero block size")
             toRead = min(totalSize, blockSize)
-            read += self.read_n(toRead)
+            blocks.append(self.read_n(toRead, copy=False))
             totalSize -= toRead
-        return read
+        return b"".join(blocks)
     
     def read_file(self):
         totalSize = self.read_four()
         return self.read_section(totalSize)
 
-    def read_four(self):
-        data = struct.unpack("<I", self.decomp[self.seek:self.seek+4])[0]
-        self.seek += 4
-        return data
-    def read_one(self):
-        data = struct.unpack("B", self.decomp[self.seek:self.seek+1])[0]
-        self.seek += 1
-        return data
-    def read_two(self):
-        data = struct.unpack("H", self.decomp[self.seek:self.seek+2])[0]
-        self.seek += 2
-        return data
-    def read_n(self,n):
-        data = self.decomp[self.seek:self.seek+n]
-        self.seek += n
-        return data
-    def read_four_s(self):
-        data = struct.unpack("<i", self.decomp[self.seek:self.seek+4])[0]
-        self.seek += 4
-        return data
-
-    def read_posVector(self):
-        return [self.read_four(), self.read_four(), self.read_four()]
-
-    def read_and_write_four(self):
-        data = self.read_four()
-        self.write_four(data)
-        return data
-    def read_and_write_n(self, n):
-        data = self.read_n(n)
-        self.write_data(data)
-        return data
-
-    def read_and_write_one(self):
-        data = self.read_one()
-        self.write_one(data)
-        return data
-
-    def read_and_write_four_s(self):
-        data = self.read_four_s()
-        self.write_four_s(data)
-        return data
-    def read_and_write_two(self):
-        data = self.read_two()
-        self.write_two(data)
-        return data
+    def skip_file(self):
+        totalSize = self.read_four()
+        while totalSize > 0:
+            blockSize = self.read_four()
+            if blockSize == 0:
+                raise ValueError("Zero block size")
+            toRead = min(totalSize, blockSize)
+            self.skip(toRead)
+            totalSize -= toRead
+
+    # Input that is passed through unchanged isn't written field by field. Everything from
+    # self.span_start up to self.seek is pending and gets copied over as one slice by copy_span
+    # before anything new is written. drop_span throws the pending input away instead, for fields
+    # that are replaced.
+    def copy_span(self):
+        if self.seek > self.span_start:
+            self.write_data(self.view[self.span_start:self.seek])
+        self.span_start = self.seek
+
+    def drop_span(self):
+        self.span_start = self.seek
+
     def write_two(self, data):
-        self.out_str += struct.pack("H", data)
+        self.out += U16.pack(data)
     def write_four(self, ourInt):
-        self.out_str += struct.pack("<I", ourInt)
+        self.out += U32.pack(ourInt)
     
     def write_four_s(self, ourInt):
-        self.out_str += struct.pack("<i", ourInt)
+        self.out += S32.pack(ourInt)
     
     def write_data(self, data):
-        self.out_str += data
+        self.out += data
 
     def write_one(self, data):
-        self.out_str += struct.pack("B", data)
+        self.out += U8.pack(data)
     
     def write_file(self, data):
         size = len(data)
@@ -146,25 +135,20 @@ class ObsAdd:
             toWrite -= blockSize
             i += blockSize
 
-    def read_and_write_camera(self, loadFlags):
+    def skip_camera(self, loadFlags):
         if loadFlags & LOAD_FLAGS_CAMERA1:
-            self.read_and_write_four()
+            self.skip(4)
         if loadFlags & LOAD_FLAGS_CAMERA2:
-            self.read_and_write_four()
+            self.skip(4)
         if loadFlags & LOAD_FLAGS_CAMERA3:
-            self.read_and_write_four()
+            self.skip(4)
         if loadFlags & LOAD_FLAGS_CAMERA46:
-            self.read_and_write_n(0xc)    
-            self.read_and_write_n(0xc)
-            self.read_and_write_n(0xc)
-        return
+            self.skip(0x24)
 
-    def read_and_write_update_time(self, loadFlags):
+    def read_update_time(self, loadFlags):
         if loadFlags & LOAD_FLAGS_TIME:
-            up_time = self.read_and_write_one()
-        else:
-            up_time = self.read_and_write_four()
-        return up_time
+            return self.read_one()
+        return self.read_four()
     
     def read_num_commands(self, loadFlags):
         if loadFlags & LOAD_FLAGS_COMMANDS_FEW:
@@ -173,19 +157,14 @@ class ObsAdd:
             return 0
         return self.read_four()
 
-    def read_and_write_command(self, loadFlags):
-        test = self.read_and_write_one()
+    def skip_command(self):
+        test = self.read_one()
         if test != 0:
-            cmd_type = self.read_and_write_four()
-            before = self.seek
-            cmd = Commands.Command.get_command(cmd_type) #TODO
-            cmd.read(self)
-            afterseek = self.seek
-            self.write_data(self.decomp[before:afterseek])
-            return cmd
-        return None
-
-    def read_and_write_sync(self, loadFlags):
+            cmd_type = self.read_four()
+            if not Commands.registry.skip(self, cmd_type, Commands.VARIANT_EE if self.is_ee else Commands.VARIANT_AOT):
+                raise NotImplementedError("Command " + hex(cmd_type) + " not implemented")
+
+    def skip_sync(self, loadFlags):
         if self.is_ee:
             field_4c = 1
             do_it = False
@@ -198,32 +177,19 @@ class ObsAdd:
                 if field_4c != 0:
                     do_it = True
             if do_it:
-                decider = self.read_and_write_one()
+                decider = self.read_one()
                 if decider != 0:
-                    self.read_and_write_sync_update()
+                    self.skip_sync_update()
         else:
             if self.field_8 >= 2:
                 return
             raise NotImplementedError("Field 8 weird")
 
-    def read_and_write_sync_update(self):
-        numSyncDatas = self.read_and_write_four()
-
-        for i in range(numSyncDatas):
-            first = self.read_and_write_one()
-            self.read_and_write_one()
-            self.read_and_write_two() #todo this was bugged i need to check
-            if first & 0xf != 0x5:
-                self.read_and_write_four()
-            self.read_and_write_four()
-            self.read_and_write_four()
-        ar = 0
-        # self.write_four(0)
-        ar = self.read_and_write_four()
-        for i in range(ar):
-            # self.read_four()
-            # self.write_four(0)
-            self.read_and_write_four()
+    def skip_sync_update(self):
+        numSyncDatas = self.read_four()
+        self.skip_sync_entries(numSyncDatas)
+        ar = self.read_four()
+        self.skip(4 * ar)
     
     def write_resign_command(self, playerId, resignerId):
         self.write_one(1)
@@ -248,81 +214,76 @@ class ObsAdd:
         # self.write_four(0xffffffff)
 
     def parse_update_and_add_resign_commands(self, do_add_command):
-        selectedUnits = []
-        commands = []
-
+        # Updates are passed through as they are, except the one we add the resign command to
+        start = self.seek
         loadFlags = self.read_one()
-        oldFlags = loadFlags
-        if loadFlags & LOAD_FLAGS_COMMANDS_MANY:
-            raise NotImplementedError("Haven't implemented lots of commands in one update yet")
-        if do_add_command:
-            oldFlags = loadFlags
-            loadFlags |= LOAD_FLAGS_COMMANDS_FEW
-            # print(hex(loadFlags),("After header seek =", hex(len(self.out_str))))
-
-        self.write_one(loadFlags)
+        self.skip_camera(loadFlags)
+        upTime = self.read_update_time(loadFlags)
+        countStart = self.seek
+        numCommands = self.read_num_commands(loadFlags)
 
-        self.read_and_write_camera(loadFlags)
-
-        upTime = self.read_and_write_update_time(loadFlags)
-        
-        if oldFlags & LOAD_FLAGS_COMMANDS_FEW:
-            # Read the commands
-            numCommands = self.read_num_commands(loadFlags)
-        else:
-            numCommands = 0
-        # commands = [None] * numCommands
         if do_add_command:
+            # Rewrite the flags and the number of commands, with the camera and time in between as they were
+            self.seek = start
+            self.copy_span()
+            if loadFlags & LOAD_FLAGS_COMMANDS_MANY:
+                countSize = 4
+            elif loadFlags & LOAD_FLAGS_COMMANDS_FEW:
+                countSize = 1
+                if numCommands + 1 > 0xff:
+                    # Doesn't fit in a byte anymore
+                    loadFlags = (loadFlags & ~LOAD_FLAGS_COMMANDS_FEW) | LOAD_FLAGS_COMMANDS_MANY
+            else:
+                countSize = 0
+                loadFlags |= LOAD_FLAGS_COMMANDS_FEW
+            self.write_one(loadFlags)
+            self.write_data(self.view[start+1:countStart])
+            if loadFlags & LOAD_FLAGS_COMMANDS_MANY:
+                self.write_four(numCommands + 1)
+            else:
+                self.write_one(numCommands + 1)
             # We just write ourself a resign command in this case
-
-            # self.write_one(numCommands + self.obs_id)
-            self.write_one(numCommands + 1)
             self.write_resign_command(1, self.obs_id)
             # for i in range(1, self.obs_id+1): 
             #     self.write_resign_command(i, self.obs_id)
-            # print(hex(loadFlags),("After header seek =", hex(len(self.out_str))))
-        else:
-            if oldFlags & LOAD_FLAGS_COMMANDS_FEW:
-                self.write_one(numCommands)
-        
+            self.seek = countStart + countSize
+            self.drop_span()
 
         for i in range(numCommands):
-            cmd = self.read_and_write_command(loadFlags) #TODO
-            # cmd = commands[i]
-
+            self.skip_command()
 
         # Read the selected units
         if loadFlags & LOAD_FLAGS_SELECTED_UNITS:
-            numUnits = self.read_and_write_one()
-            selectedUnits = [0] * numUnits
-            for i in range(numUnits):
-                selectedUnits[i] = self.read_and_write_four()
-        
+            numUnits = self.read_one()
+            self.skip(4 * numUnits)
         
         # This seems to be the affected player ids
-        if not do_add_command:
-            smth = self.read_and_write_one()
-            for i in range(smth):
-                self.read_and_write_one()
-        else:
+        if do_add_command:
             # write ourself as an affected player (by the resign command)
+            self.copy_span()
             smth = self.read_one()
+            self.drop_span()
             self.write_one(smth+1)
             self.write_one(self.obs_id)
-            for i in range(smth):
-                self.read_and_write_one()
+        else:
+            smth = self.read_one()
+        self.skip(smth)
             
         # # byte read from header field_4c
 
         # # Read sync info
-        self.read_and_write_sync(loadFlags)
+        self.skip_sync(loadFlags)
 
         # if self.field_8 < 1:
         #     # self.validate_read()
         #     pass
         
     def add_obs(self):
+        # Returns True once the output is written, False if the players couldn't be read and nothing was written
+        # The header up to here is copied with the first span
+        self.copy_span()
         lastGameSettingsXml = self.read_file()
+        self.drop_span()
         
         self.xml = lastGameSettingsXml.decode("utf-16")
         
@@ -367,86 +328,86 @@ class ObsAdd:
 
         self.write_file(new_root)
 
-        # read map script (recordGameRandomMap.xs)
-        self.recordGameMap = self.read_file()
-        self.write_file(self.recordGameMap)
+        # map script (recordGameRandomMap.xs) is left as it is
+        self.skip_file()
 
         # Read info about the players (civ, team)
+        self.copy_span()
         numPlayers = self.read_four()
+        self.drop_span()
         self.obs_id = numPlayers
         if numPlayers != realNumPlayers + 1:
             raise ValueError("Doesn't match")
         newNumPlayers = numPlayers + 1
         self.write_four(newNumPlayers)
-        for i in range(numPlayers):
-            self.write_four(self.read_four())
-            self.write_four(self.read_four())
+        self.skip(8 * numPlayers)
         # Write the civ, team for our new obs
+        self.copy_span()
         self.write_four(1)
         self.write_four(0xffffffff) # team -1
         
         # Can't remember what this is
         # Done by   AGame::doesSomeGsRead
-        self.write_data(self.read_n(13))
-        self.write_four(self.read_four())
+        self.skip(13)
+        self.skip(4)
 
         numTeams = self.read_four()
-        self.write_four(numTeams)
         for i in range(numTeams):
-            read_player = self.read_and_write_one()
+            read_player = self.read_one()
             if read_player == 0:
                 continue
-            self.read_and_write_four()
+            self.skip(4)
             
 
-            teamId = self.read_and_write_four()
-            sz = self.read_and_write_four()
-            teamDesc = self.read_and_write_n(sz)
-            newNum = self.read_and_write_four() #might be color stuff, can't remember
-            for i in range(newNum):
-                data = self.read_and_write_four()
+            teamId = self.read_four()
+            sz = self.read_four()
+            self.skip(sz) # team description
+            newNum = self.read_four() #might be color stuff, can't remember
+            self.skip(4 * newNum)
 
+        self.copy_span()
         alsoNumPlayers = self.read_four()
+        self.drop_span()
         if alsoNumPlayers != numPlayers:
             raise ValueError("Num players check")
 
         self.write_four(newNumPlayers)
         for i in range(alsoNumPlayers):
-            tester = self.read_and_write_one()
+            tester = self.read_one()
 
             if tester == 0:
                 continue
-            check_3f = self.read_and_write_four_s()
-            god_flags_idk_dude = self.read_and_write_one()
-            god_flags_idk_dude2 = self.read_and_write_one()
-            maybe_stance = self.read_and_write_four()
+            check_3f = self.read_four_s()
+            god_flags_idk_dude = self.read_one()
+            god_flags_idk_dude2 = self.read_one()
+            maybe_stance = self.read_four()
 
 
             # sub_512b30
 
-            some = self.read_and_write_four()
-            more = self.read_and_write_n(2*some)
+            some = self.read_four()
+            self.skip(2*some) # name
 
-            field_10 = self.read_and_write_four()
-            type_flags = self.read_and_write_one()
+            field_10 = self.read_four()
+            type_flags = self.read_one()
 
-            culture = self.read_and_write_four()
-            civ = self.read_and_write_four()
+            culture = self.read_four()
+            civ = self.read_four()
 
-            field_18 = self.read_and_write_four() #seems to be team again
-            field_4b4 = self.read_and_write_four()
-            field_4b8 = self.read_and_write_four()
+            field_18 = self.read_four() #seems to be team again
+            field_4b4 = self.read_four()
+            field_4b8 = self.read_four()
             if check_3f >= 0x3f:
-                test2 = self.read_and_write_four_s()
+                test2 = self.read_four_s()
                 if test2 > 0x10:
                     print("PL NUM ERR")
-                    return
+                    return False
                 if test2 > 0:
-                    for j in range(test2):
-                        rel = self.read_and_write_four()
-            colors = self.read_and_write_four()
+                    self.skip(4 * test2) # relations
+            colors = self.read_four()
 
         # Now we write a new player
+        self.copy_span()
         self.write_one(1)
         self.write_four_s(75)
         self.write_one(0) # flags 1
@@ -483,16 +444,20 @@ class ObsAdd:
             self.parse_update_and_add_resign_commands(False)
         self.parse_update_and_add_resign_commands(True)
         self.write_out()
+        return True
 
 
     def write_out(self):
-        data = self.out_str + self.decomp[self.seek:]
-        compressed = zlib.compress(data)
-        with open(self.outpath, 'wb') as f:
+        # Whatever hasn't been written yet is copied over as it is
+        rest = self.view[self.span_start:]
+        size = len(self.out) + len(rest)
+        # Written next to it first, so a half written output never looks up to date to add_obs_batch
+        tmppath = self.outpath + ".tmp"
+        with open(tmppath, 'wb') as f:
             f.write(b"l33t")
-            f.write(struct.pack("<I", len(data))) # WE NEED TO FIX THE SYNC BOBBER STUFF
-            f.write(compressed)
-            loc = len(b"l33t") + 4 + len(compressed)
+            f.write(struct.pack("<I", size)) # WE NEED TO FIX THE SYNC BOBBER STUFF
+            written = pzlib.compress_to(f, [self.out, rest], self.level, self.threads)
+            loc = len(b"l33t") + 4 + written
             loc_bytes = struct.pack("<I", (loc))
             
             # print(self.footer, self.footer[-8])
@@ -519,18 +484,87 @@ class ObsAdd:
             new_footer = footer_data + loc_bytes + self.footer[-4:]
 
             f.write(new_footer)
+        os.replace(tmppath, self.outpath)
         print("Saved to " + self.outpath)
 
         
 # ObsAdd("rcxs/momo_vs_kvoth_1_.rcx", is_ee=False).add_obs()
 # ObsAdd("rcxs/3ppl.rcx", is_ee=True).add_obs()
 
+def find_recordings(target):
+    # target is a folder or a glob. Outputs of earlier runs are left out
+    if os.path.isdir(target):
+        paths = glob.glob(os.path.join(glob.escape(target), "*.rcx"))
+    else:
+        paths = glob.glob(target)
+    return sorted(path for path in paths if not path.endswith(OUTPUT_SUFFIX))
+
+def is_up_to_date(filepath):
+    outpath = output_path(filepath)
+    return os.path.exists(outpath) and os.path.getmtime(outpath) >= os.path.getmtime(filepath)
+
+def add_obs_to_file(filepath, is_ee, observer_name, level=-1, threads=None):
+    # Runs in a worker process of add_obs_batch. Failures are returned instead of raised so one bad file doesn't stop the rest
+    start = time.time()
+    result = {"file": filepath}
+    try:
+        if ObsAdd(filepath, is_ee=is_ee, observer_name=observer_name, level=level, threads=threads).add_obs():
+            result["status"] = "ok"
+            result["output"] = output_path(filepath)
+        else:
+            result["status"] = "failed"
+            result["error"] = "PL NUM ERR, nothing written"
+    except Exception as e:
+        result["status"] = "failed"
+        result["error"] = type(e).__name__ + ": " + str(e)
+    result["seconds"] = round(time.time() - start, 3)
+    return result
+
+def add_obs_batch(target, observer_name, is_ee=True, jobs=None, level=-1, force=False):
+    # Adds the observer to every recording in target using a process pool. Yields a result dict per file as they finish
+    # Recordings whose output is newer than them are skipped unless force is set
+    todo = []
+    for filepath in find_recordings(target):
+        if not force and is_up_to_date(filepath):
+            yield {"file": filepath, "status": "skipped", "output": output_path(filepath)}
+        else:
+            todo.append(filepath)
+    if not todo:
+        return
+    # The files are already spread over the cores, so each one compresses on a single thread
+    with ProcessPoolExecutor(jobs) as pool:
+        futures = [pool.submit(add_obs_to_file, filepath, is_ee, observer_name, level, 1) for filepath in todo]
+        for future in as_completed(futures):
+            yield future.result()
+
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument('filename')
+    parser.add_argument('filename', help="a recording, or a folder or glob of them to do in parallel")
     parser.add_argument('observer_name', default="Observer(Stu)", nargs="?")
+    parser.add_argument('--level', type=int, default=-1, help="zlib compression level of the output")
+    parser.add_argument('--threads', type=int, default=None, help="threads used to compress the output")
+    parser.add_argument('--jobs', type=int, default=None, help="recordings done at once for a folder or glob, defaults to the number of cores")
+    parser.add_argument('--summary', default=None, help="file to write a JSON line per recording to for a folder or glob")
+    parser.add_argument('--force', action="store_true", help="redo recordings whose output is already up to date")
     args = parser.parse_args()
-    ObsAdd(args.filename, is_ee=True, observer_name=args.observer_name).add_obs()
+    if os.path.isfile(args.filename):
+        ObsAdd(args.filename, is_ee=True, observer_name=args.observer_name, level=args.level, threads=args.threads).add_obs()
+        return
+
+    summary = open(args.summary, "w") if args.summary else None
+    counts = {}
+    try:
+        for result in add_obs_batch(args.filename, args.observer_name, jobs=args.jobs, level=args.level, force=args.force):
+            counts[result["status"]] = counts.get(result["status"], 0) + 1
+            if result["status"] == "failed":
+                print(result["file"] + "  " + result["error"])
+            if summary is not None:
+                summary.write(json.dumps(result) + "\n")
+                summary.flush()
+    finally:
+        if summary is not None:
+            summary.close()
+    print(", ".join(str(counts[status]) + " " + status for status in sorted(counts)) if counts else "No recordings found")
 
 if __name__ == "__main__":
     main()
@@ -4,14 +4,37 @@ import zlib
 import xml.etree.ElementTree as ET
 import ntpath
 import os
+import re
 import sys
 import argparse
+import hashlib
+import io
+import json
+import pickle
+import sqlite3
+import signal
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import redirect_stdout
+
+try:
+    import numpy as np
+except ImportError:
+    # Only needed for CommandColumns
+    np = None
 
 import commands as Commands
+from cursor import Cursor, sync_entries_end, unpack_u16, unpack_u32, unpack_s32, unpack_f32, unpack_vec3, unpack_pos_vector
 
 
 AOM_PATH = "/mnt/c/Program Files (x86)/Steam/steamapps/common/Age of Mythology/"
 AOM_VERSION = "2.8"
+# Game data used for AoT (Voobly) recordings, see Rec.get_game_data. AOT_VERSION "" means proto.xml and techtree.xml
+AOT_PATH = "/mnt/c/Program Files (x86)/Microsoft Games/Age of Mythology/"
+AOT_VERSION = ""
 
 
 LOAD_FLAGS_TIME = 0x1
@@ -23,11 +46,39 @@ LOAD_FLAGS_COMMANDS_FEW = 0x20
 LOAD_FLAGS_COMMANDS_MANY = 0x40
 LOAD_FLAGS_SELECTED_UNITS = 0x80
 
+# Streaming mode keeps at most about this many inflated bytes in memory
+STREAM_WINDOW = 0x100000
+STREAM_READ_SIZE = 0x10000
+# Header only mode only needs to get just past the player/team tables
+HEADER_WINDOW = 0x4000
+HEADER_READ_SIZE = 0x1000
+
 PLAYER_TYPE_OBS = 4
 PLAYER_TYPE_HUMAN = 0
 PLAYER_TYPE_COMP = 1
 
 START_LAST_TEAM_ID = -3
+
+# All that analyze_updates needs to find the winner
+OUTCOME_COMMANDS = (Commands.ResignCommand,)
+# Seconds analyze_group gives each recording
+ANALYZE_TIMEOUT = 300
+
+# Sidecar update index files, written next to the recording
+INDEX_MAGIC = b"RCXI"
+INDEX_VERSION = 1
+INDEX_HEADER = struct.Struct("<4sIQQ16sI") # magic, version, file size, mtime_ns, hash, number of updates
+INDEX_SUFFIX = ".idx"
+
+# Bump when parse_header changes what it finds, so HeaderCache entries from older versions are parsed again
+PARSER_VERSION = 1
+HEADER_CACHE_FILE = "rcx_headers.sqlite"
+
+# Where compiled game data is kept, see GameData. Bump SNAPSHOT_VERSION when what is stored changes
+GAME_DATA_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "rcx_parser")
+SNAPSHOT_VERSION = 1
+# The default HeaderCache, kept per user rather than next to the recordings
+HEADER_CACHE_PATH = os.path.join(GAME_DATA_CACHE_DIR, HEADER_CACHE_FILE)
 class CivManager:
     def __init__(self, is_ee):
         ee_gods = ["Zeus", "Poseidon", "Hades", "Isis", "Ra", "Set", "Odin", "Thor", "Loki", "Kronos", "Oranos", "Gaia", "Fu Xi", "Nu Wa", "Shennong", "4", "5", "6", "7", "8", "9", "10", "Nature", "12", "13", "14", "15", "16"]
@@ -48,98 +99,219 @@ class CivManager:
     def get_nature_idx(self):
         return self.nature_idx
 
-class ProtoUnitDatabase:
-    def __init__(self):
-        proto_unit_path = AOM_PATH + os.sep + "data" + os.sep + "proto" + AOM_VERSION + ".xml"
-        tree = ET.parse(proto_unit_path)
-        self.tree = tree
-        self.units = tree.findall("unit")
-        # Language path for translating displayid
-        en_lang_path = AOM_PATH + os.sep + "Language" + os.sep + "en" + os.sep + "en-language.txt"
-        with open(en_lang_path, 'r', encoding="utf-16-le") as f:
-            lang_lines = f.readlines()
-        self.display_map = {}
-        for line in lang_lines:
-            tokens = line.split()
+def read_language_file(path, display_ids=None):
+    # Maps the string ids in a language file to their text. If display_ids is given only those are kept
+    display_map = {}
+    with open(path, 'r', encoding="utf-16-le") as f:
+        for line in f:
+            tokens = line.split(None, 1)
             if len(tokens) > 1:
                 if tokens[0].isdigit():
                     display_id = int(tokens[0])
-                    text = line[len(tokens[0]):].strip()
-                    self.display_map[display_id] = text[1:-1]
-                
-    
+                    if display_ids is None or display_id in display_ids:
+                        text = line[len(tokens[0]):].strip()
+                        display_map[display_id] = text[1:-1]
+    return display_map
+
+class ProtoUnitDatabase:
+    # Only the name and display name id of each unit are kept, by unit id
+    # The language file is only read the first time a display name is needed
+    def __init__(self, aom_path=None, aom_version=None):
+        # aom_path and aom_version default to AOM_PATH and AOM_VERSION
+        aom_path = AOM_PATH if aom_path is None else aom_path
+        aom_version = AOM_VERSION if aom_version is None else aom_version
+        # Language path for translating displayid
+        proto_unit_path, tech_tree_path, self.language_path = game_data_paths(aom_path, aom_version)
+        self.display_map = None
+        self.names = {}
+        self.display_ids = {}
+
+        # Units are the elements right under the root. Each one is thrown away once its fields are taken
+        depth = 0
+        root = None
+        for event, elem in ET.iterparse(proto_unit_path, events=("start", "end")):
+            if event == "start":
+                if root is None:
+                    root = elem
+                depth += 1
+                continue
+            depth -= 1
+            if depth == 1:
+                if elem.tag == "unit":
+                    id = int(elem.attrib["id"])
+                    # If ids repeat the first unit is used
+                    if id not in self.names:
+                        self.names[id] = elem.attrib["name"]
+                        display_ele = elem.find("displaynameid")
+                        if display_ele is not None:
+                            self.display_ids[id] = int(display_ele.text)
+                root.clear()
+
     def get_name(self, id):
-        for unit in self.units:
-            if int(unit.attrib["id"]) == id:
-                return unit.attrib["name"]
+        return self.names.get(id)
+
+    def load_language(self):
+        if self.display_map is None:
+            self.display_map = read_language_file(self.language_path, set(self.display_ids.values()))
 
     def get_displayname(self, id):
-        for unit in self.units:
-            if int(unit.attrib["id"]) == id:
-                display_id = int(unit.find("displaynameid").text)
-                return self.display_map[display_id]
+        if id not in self.names:
+            return None
+        self.load_language()
+        return self.display_map[self.display_ids[id]]
+
+# The name of a tech, from the line it starts on
+TECH_NAME = re.compile(r"tech name=([\"'])(.*?)\1", re.IGNORECASE)
+
 class TechTreeDatabase:
     # Tech tree uses an odd format for ids
     # It doesn't store the actual id. DBID is not used as the tech id
     # Instead its just the order of techs in the file. 
     # e.g. the first tech in the file has an id of 0
 
-    def __init__(self):
+    def __init__(self, aom_path=None, aom_version=None):
+        aom_path = AOM_PATH if aom_path is None else aom_path
+        aom_version = AOM_VERSION if aom_version is None else aom_version
         self.techs = []
-        tech_tree_path = AOM_PATH + os.sep + "data" + os.sep + "techtree" + AOM_VERSION + ".xml"
+        tech_tree_path = game_data_paths(aom_path, aom_version)[1]
         with open(tech_tree_path, 'r') as f:
             for line in f:
-                if "tech name=".lower() in line.lower():
-                    startFind = "name="
-                    endFind = "type="
-                    self.techs.append(line[line.find(startFind)+len(startFind)+1:line.find(endFind)-2])
+                match = TECH_NAME.search(line)
+                if match is not None:
+                    self.techs.append(match.group(2))
 
     def get_tech(self, id):
         return self.techs[id]
 
+def game_data_paths(aom_path, aom_version):
+    # proto, techtree and language file of an install
+    return (aom_path + os.sep + "data" + os.sep + "proto" + aom_version + ".xml",
+        aom_path + os.sep + "data" + os.sep + "techtree" + aom_version + ".xml",
+        aom_path + os.sep + "Language" + os.sep + "en" + os.sep + "en-language.txt")
+
+def snapshot_path(aom_path, aom_version):
+    # The name depends on the version and the size and mtime of every source file, so a changed install
+    # gets a new snapshot instead of a stale one. The language file is only needed for display names, so it
+    # can be missing (the snapshot has no display names then, like ProtoUnitDatabase before it reads them)
+    proto_unit_path, tech_tree_path, language_path = game_data_paths(aom_path, aom_version)
+    key = [SNAPSHOT_VERSION, aom_version]
+    for path in (proto_unit_path, tech_tree_path):
+        st = os.stat(path)
+        key.append((st.st_size, st.st_mtime_ns))
+    if os.path.exists(language_path):
+        st = os.stat(language_path)
+        key.append((st.st_size, st.st_mtime_ns))
+    else:
+        key.append(None)
+    # Each version of an install has its own prefix, save_snapshot only replaces snapshots with the same one
+    install = hashlib.blake2b(repr((os.path.abspath(aom_path), aom_version)).encode(), digest_size=8).hexdigest()
+    digest = hashlib.blake2b(repr(key).encode(), digest_size=16).hexdigest()
+    return os.path.join(GAME_DATA_CACHE_DIR, "gamedata-" + install + "-" + digest + ".pickle")
+
+class GameData:
+    # The databases for one install and version of the game, loaded the first time one is used
+    # They are loaded from a snapshot in GAME_DATA_CACHE_DIR when there's a current one. Otherwise the game
+    # files are parsed and a snapshot is written for next time
+    def __init__(self, aom_path, aom_version, use_snapshot=True):
+        self.aom_path = aom_path
+        self.aom_version = aom_version
+        self.use_snapshot = use_snapshot
+        self._proto_units = None
+        self._tech_tree = None
+
+    @property
+    def proto_units(self):
+        if self._proto_units is None:
+            self.load()
+        return self._proto_units
+
+    @property
+    def tech_tree(self):
+        if self._tech_tree is None:
+            self.load()
+        return self._tech_tree
+
+    def load(self):
+        if not self.use_snapshot:
+            self._proto_units = ProtoUnitDatabase(self.aom_path, self.aom_version)
+            self._tech_tree = TechTreeDatabase(self.aom_path, self.aom_version)
+            return
+        path = snapshot_path(self.aom_path, self.aom_version)
+        if self.load_snapshot(path):
+            return
+        self._proto_units = ProtoUnitDatabase(self.aom_path, self.aom_version)
+        if os.path.exists(self._proto_units.language_path):
+            self._proto_units.load_language()
+        self._tech_tree = TechTreeDatabase(self.aom_path, self.aom_version)
+        self.save_snapshot(path)
+
+    def load_snapshot(self, path):
+        # Plain dicts and lists are stored rather than the databases, so it loads no matter which module name
+        # this file was imported as
+        try:
+            with open(path, "rb") as f:
+                names, display_ids, display_map, language_path, techs = pickle.load(f)
+        except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+            return False
+        proto_units = ProtoUnitDatabase.__new__(ProtoUnitDatabase)
+        proto_units.names = names
+        proto_units.display_ids = display_ids
+        proto_units.display_map = display_map
+        proto_units.language_path = language_path
+        tech_tree = TechTreeDatabase.__new__(TechTreeDatabase)
+        tech_tree.techs = techs
+        self._proto_units = proto_units
+        self._tech_tree = tech_tree
+        return True
+
+    def save_snapshot(self, path):
+        proto_units = self._proto_units
+        state = (proto_units.names, proto_units.display_ids, proto_units.display_map, proto_units.language_path,
+            self._tech_tree.techs)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Snapshots of this install and version for older versions of the files aren't needed anymore
+            prefix = os.path.basename(path).rsplit("-", 1)[0] + "-"
+            for old in os.listdir(os.path.dirname(path)):
+                if old.startswith(prefix) and old != os.path.basename(path):
+                    os.remove(os.path.join(os.path.dirname(path), old))
+            tmppath = path + ".tmp"
+            with open(tmppath, "wb") as f:
+                pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmppath, path)
+        except OSError:
+            # Not being able to cache isn't a reason to fail
+            pass
+
+# Shared by every Rec in the process, by (path, version). It is least recently used first and holds at most
+# GAME_DATA_CACHE_SIZE entries, so a mix of versions doesn't keep all of them in memory
+game_data_registry = OrderedDict()
+GAME_DATA_CACHE_SIZE = 4
+
+def get_game_data(aom_path=None, aom_version=None):
+    # aom_path and aom_version default to AOM_PATH and AOM_VERSION, so changing those picks other data
+    key = (AOM_PATH if aom_path is None else aom_path, AOM_VERSION if aom_version is None else aom_version)
+    game_data = game_data_registry.get(key)
+    if game_data is None:
+        game_data = GameData(*key)
+        game_data_registry[key] = game_data
+        while len(game_data_registry) > GAME_DATA_CACHE_SIZE:
+            game_data_registry.popitem(last=False)
+    else:
+        game_data_registry.move_to_end(key)
+    return game_data
+
 def path_leaf(path):
     head, tail = ntpath.split(path)
     return tail or ntpath.basename(head)
 
-class RcxReader:
-    decomp = None
-    seek = 0
+class RcxReader(Cursor):
     is_ee = True
+    # SyncData to capture the sync values into, they are skipped when None
+    sync = None
 
     def __init__(self, filepath):
-        # Read the data
-        with open(filepath, "rb") as f:
-            all = f.read()
-
-        # Last sixteen raw bytes are a magic footer along with some data
-        last_sixteen = all[-16:]
-        if last_sixteen[:2] != b'RG' or last_sixteen[4:8] != b'\xd2\x02\x96I':
-            raise ValueError("BAD footer")
-        self.uncompressed_seek = struct.unpack("<I", last_sixteen[8:12])[0]
-        self.field_18 = struct.unpack("<I", last_sixteen[0xc:])[0]
-
-
-        # Check the header magic
-        magic = all[:4]
-        if magic != b"l33t":
-            raise ValueError("Bad magic value")
-        
-        
-        size = struct.unpack("<I", all[4:8])[0]
-        rest = all[8:]
-
-        # Decompress data
-        try:
-            decomp = zlib.decompress(rest)
-        except zlib.error as e:
-            raise ValueError("Recording corrupt")
-        # Sanity check size
-        if size != len(decomp):
-            raise ValueError("Error in decompression. File might be corrupted")
-        
-        # Setup vars
-        self.decomp = decomp
-        
+        self.open_data(filepath)
 
         self.field_8 = self.read_four() # Should always be 3
         if not self.field_8 == 3:
@@ -187,6 +359,8 @@ class RcxReader:
             n = self.read_four()
             for i in range(n):
                 self.read_four()
+        # Known from here on, parse_svx already decodes commands
+        self.variant = Commands.VARIANT_EE if self.is_ee else Commands.VARIANT_AOT
         
         self.f_54 = self.read_four() # Maybe is_restore
         if not self.f_54:
@@ -205,6 +379,46 @@ class RcxReader:
         self.field_8 = 3 # This actually comes from some data. Should probably fix this at some point
 
 
+    def open_data(self, filepath):
+        # Read the data
+        with open(filepath, "rb") as f:
+            all = f.read()
+
+        # Last sixteen raw bytes are a magic footer along with some data
+        self.read_footer(all[-16:])
+
+        # Check the header magic
+        size = self.read_magic(all[:8])
+        rest = all[8:]
+
+        # Decompress data
+        try:
+            decomp = zlib.decompress(rest)
+        except zlib.error as e:
+            raise ValueError("Recording corrupt")
+        # Sanity check size
+        if size != len(decomp):
+            raise ValueError("Error in decompression. File might be corrupted")
+        
+        # Setup vars
+        self.set_data(decomp)
+        self.size = size
+
+    def read_footer(self, last_sixteen):
+        if last_sixteen[:2] != b'RG' or last_sixteen[4:8] != b'\xd2\x02\x96I':
+            raise ValueError("BAD footer")
+        self.uncompressed_seek = struct.unpack("<I", last_sixteen[8:12])[0]
+        self.field_18 = struct.unpack("<I", last_sixteen[0xc:])[0]
+
+    def read_magic(self, header):
+        magic = header[:4]
+        if magic != b"l33t":
+            raise ValueError("Bad magic value")
+        return struct.unpack("<I", header[4:8])[0]
+
+    def close(self):
+        self.set_data(b"")
+
     def readExpectedTag(self, expected_tag):
         real_tag = self.read_two()
         if real_tag != expected_tag:
@@ -474,8 +688,7 @@ class RcxReader:
             data = self.read_one()
             if data != 0:
                 v_10 = self.read_four() #cmd_type
-                cmd = Commands.Command.get_command(v_10)
-                cmd.read(self)
+                cmd = self.decode_command(v_10)
 
         # There might be some if here. I'm ignoring it.
         v_8 = self.read_four()
@@ -483,8 +696,7 @@ class RcxReader:
             data = self.read_one()
             if data != 0:
                 v_10 = self.read_four() #cmd_type
-                cmd = Commands.Command.get_command(v_10)
-                cmd.read(self)
+                cmd = self.decode_command(v_10)
         a_8 = self.read_four()
         if a_8 == 0x10:
             v_10 = self.read_four()
@@ -739,32 +951,6 @@ class RcxReader:
 
 
 
-    def read_four(self):
-        data = struct.unpack("<I", self.decomp[self.seek:self.seek+4])[0]
-        self.seek += 4
-        return data
-    def read_float(self):
-        data = struct.unpack("f", self.decomp[self.seek:self.seek+4])[0]
-        self.seek += 4
-        return data
-
-    def read_one(self):
-        data = struct.unpack("B", self.decomp[self.seek:self.seek+1])[0]
-        self.seek += 1
-        return data
-    def read_two(self):
-        data = struct.unpack("H", self.decomp[self.seek:self.seek+2])[0]
-        self.seek += 2
-        return data
-    def read_n(self,n):
-        data = self.decomp[self.seek:self.seek+n]
-        self.seek += n
-        return data
-    def read_four_s(self):
-        data = struct.unpack("<i", self.decomp[self.seek:self.seek+4])[0]
-        self.seek += 4
-        return data
-
     def read_camera(self, loadFlags):
         if loadFlags & LOAD_FLAGS_CAMERA1:
             self.read_four()
@@ -773,9 +959,7 @@ class RcxReader:
         if loadFlags & LOAD_FLAGS_CAMERA3:
             self.read_four()
         if loadFlags & LOAD_FLAGS_CAMERA46:
-            self.read_n(0xc)    
-            self.read_n(0xc)
-            self.read_n(0xc)
+            self.skip(0x24)
         return
     
     def get_update_time(self, loadFlags):
@@ -792,15 +976,37 @@ class RcxReader:
             return 0
         return self.read_four()
 
-    def get_command(self, loadFlags):
+    def get_command(self, loadFlags, include=None):
+        # include is a set of Command classes to decode. Others are skipped and None is returned for them
         test = self.read_one()
         if test != 0:
             cmd_type = self.read_four()
-            cmd = Commands.Command.get_command(cmd_type)
+            if include is None:
+                return self.decode_command(cmd_type)
+            cls = self.lookup_command(cmd_type)
+            if cls not in include:
+                cls.skip(self)
+                return None
+            cmd = cls()
             cmd.read(self)
             return cmd
         return None
 
+    def decode_command(self, cmd_type):
+        cmd = Commands.registry.decode(self, cmd_type, self.variant)
+        if cmd is None:
+            # We don't know the size of it, so there's no way to keep reading
+            raise NotImplementedError("Command " + hex(cmd_type) + " not implemented")
+        return cmd
+
+    def lookup_command(self, cmd_type):
+        # Command class for cmd_type, for deciding what to do with it before reading it
+        # Looked up once per command, so the registry counters see every command once
+        cls = Commands.registry.lookup(cmd_type, self.variant)
+        if cls is None:
+            raise NotImplementedError("Command " + hex(cmd_type) + " not implemented")
+        return cls
+
     def get_sync(self, loadFlags):
         if self.is_ee:
             field_4c = 1
@@ -823,35 +1029,29 @@ class RcxReader:
             raise NotImplementedError("Field 8 weird")
 
     def read_sync_update(self):
+        # The values aren't used, so unless they are being captured the entries are just stepped over
         numSyncDatas = self.read_four()
-        for i in range(numSyncDatas):
-            first = self.read_one()
-            self.read_one()
-            self.read_two() #todo this was bugged i need to check
-            if first & 0xf != 0x5:
-                self.read_four()
-            self.read_four()
-            self.read_four()
+        sync = self.sync
+        if sync is None:
+            self.skip_sync_entries(numSyncDatas)
+            ar = self.read_four()
+            self.skip(4 * ar)
+            return
+        self.skip_sync_entries(numSyncDatas, sync.entries)
         ar = self.read_four()
-
-        for i in range(ar):
-            sync_data = self.read_four()
+        sync.blocks.extend((numSyncDatas, ar))
+        sync.values.extend(self.read_u32_array(ar))
     
-    def read_posVector(self):
-        return [self.read_four(), self.read_four(), self.read_four()]
-
-    def skip(self, n):
-        self.seek += n
-
     def read_section(self, totalSize, blockSize):
-        read = b""
+        # Blocks are gathered as views and joined once, instead of making a new bytes object per block
+        blocks = []
         while totalSize > 0:
             toRead = min(totalSize, blockSize)
-            read += self.read_n(toRead)
+            blocks.append(self.read_n(toRead, copy=False))
             totalSize -= toRead
             if totalSize > 0:
                 self.seek += 4
-        return read
+        return b"".join(blocks)
     
     def read_file(self):
         totalSize = self.read_four()
@@ -861,7 +1061,183 @@ class RcxReader:
             raise ValueError("Zero block size")
         return self.read_section(totalSize, blockSize)
 
+    def skip_file(self):
+        # Same as read_file, but only moves the seek past it
+        totalSize = self.read_four()
+        blockSize = self.read_four()
+        if blockSize == 0:
+            raise ValueError("Zero block size")
+        numBlocks = (totalSize + blockSize - 1) // blockSize
+        # Every block after the first has its size in front of it
+        self.skip(totalSize + 4 * max(numBlocks - 1, 0))
+
+class StreamingRcxReader(RcxReader):
+    # Inflates the recording as the seek moves forward instead of all at once.
+    # self.decomp only holds the window starting at self.base, bytes before it have been dropped.
+    # self.seek is still the offset into the whole decompressed recording, so it can't go backwards.
+
+    def __init__(self, filepath, window=STREAM_WINDOW, read_size=STREAM_READ_SIZE):
+        self.window = window
+        self.read_size = read_size
+        super().__init__(filepath)
+
+    def open_data(self, filepath):
+        self.file = open(filepath, "rb")
+
+        # Last sixteen raw bytes are a magic footer along with some data
+        self.file.seek(-16, os.SEEK_END)
+        self.read_footer(self.file.read(16))
+
+        # Check the header magic
+        self.file.seek(0)
+        self.size = self.read_magic(self.file.read(8))
+
+        self.decompressor = zlib.decompressobj()
+        self.inflated = 0
+        self.set_data(b"")
+        self.base = 0
+
+    def close(self):
+        self.set_data(b"")
+        self.decompressor = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def inflate(self, max_length):
+        # Returns at most max_length more bytes of the recording, b"" once it is done
+        while True:
+            if self.decompressor.unconsumed_tail:
+                data = self.decompressor.unconsumed_tail
+            elif self.decompressor.eof:
+                return b""
+            else:
+                data = self.file.read(self.read_size)
+                if not data:
+                    raise ValueError("Recording corrupt")
+            try:
+                out = self.decompressor.decompress(data, max_length)
+            except zlib.error as e:
+                raise ValueError("Recording corrupt")
+            self.inflated += len(out)
+            if self.decompressor.eof:
+                # Sanity check size
+                if self.inflated != self.size:
+                    raise ValueError("Error in decompression. File might be corrupted")
+                self.file.close()
+                self.file = None
+            if out:
+                return out
+
+    def fill(self, n):
+        # Makes self.decomp hold at least n bytes from self.seek on. Returns where self.seek is in it
+        pos = self.seek - self.base
+        if pos < 0:
+            raise ValueError("Can't seek backwards while streaming")
+
+        # Drop what has been consumed already
+        consumed = min(pos, len(self.decomp))
+        chunks = [self.decomp[consumed:]]
+        self.set_data(b"")
+        self.base += consumed
+
+        # The seek may have been skipped past the end of the window
+        while self.base < self.seek:
+            data = self.inflate(min(self.seek - self.base, self.window))
+            if not data:
+                raise ValueError("Read past end of recording")
+            self.base += len(data)
+
+        have = len(chunks[0])
+        while have < n:
+            data = self.inflate(max(self.window - have, n - have))
+            if not data:
+                raise ValueError("Read past end of recording")
+            chunks.append(data)
+            have += len(data)
+        self.set_data(b"".join(chunks))
+        return 0
+
+    def read_four(self):
+        pos = self.seek - self.base
+        if pos + 4 > len(self.decomp):
+            pos = self.fill(4)
+        data = unpack_u32(self.decomp, pos)[0]
+        self.seek += 4
+        return data
+    def read_float(self):
+        pos = self.seek - self.base
+        if pos + 4 > len(self.decomp):
+            pos = self.fill(4)
+        data = unpack_f32(self.decomp, pos)[0]
+        self.seek += 4
+        return data
+
+    def read_one(self):
+        pos = self.seek - self.base
+        if pos + 1 > len(self.decomp):
+            pos = self.fill(1)
+        data = self.decomp[pos]
+        self.seek += 1
+        return data
+    def read_two(self):
+        pos = self.seek - self.base
+        if pos + 2 > len(self.decomp):
+            pos = self.fill(2)
+        data = unpack_u16(self.decomp, pos)[0]
+        self.seek += 2
+        return data
+    def read_n(self, n, copy=True):
+        pos = self.seek - self.base
+        if pos + n > len(self.decomp):
+            pos = self.fill(n)
+        if copy:
+            data = self.decomp[pos:pos+n]
+        else:
+            data = self.view[pos:pos+n]
+        self.seek += n
+        return data
+    def read_four_s(self):
+        pos = self.seek - self.base
+        if pos + 4 > len(self.decomp):
+            pos = self.fill(4)
+        data = unpack_s32(self.decomp, pos)[0]
+        self.seek += 4
+        return data
+
+    def skip_sync_entries(self, n, entries=None):
+        # Entries are at most 16 bytes, so get that much into the window unless the recording ends first
+        need = min(16 * n, self.size - self.seek)
+        pos = self.seek - self.base
+        if pos + need > len(self.decomp):
+            pos = self.fill(need)
+        self.seek = self.base + sync_entries_end(self.decomp, pos, n, entries)
+
+    def read_struct(self, st):
+        pos = self.seek - self.base
+        if pos + st.size > len(self.decomp):
+            pos = self.fill(st.size)
+        data = st.unpack_from(self.decomp, pos)
+        self.seek += st.size
+        return data
+    def read_vec3(self):
+        pos = self.seek - self.base
+        if pos + 12 > len(self.decomp):
+            pos = self.fill(12)
+        data = unpack_vec3(self.decomp, pos)
+        self.seek += 12
+        return data
+    def read_posVector(self):
+        pos = self.seek - self.base
+        if pos + 12 > len(self.decomp):
+            pos = self.fill(12)
+        data = unpack_pos_vector(self.decomp, pos)
+        self.seek += 12
+        return list(data)
+
 class Player:
+    __slots__ = ("civ", "team", "idx", "name", "isResigned", "isObserver", "civ_mgr", "resignTime")
+
     def __init__(self, civ, team, idx, civ_mgr, isObserver=False, name=""):
         self.civ = civ
         self.team = team
@@ -888,6 +1264,8 @@ class Player:
         return self.civ_mgr.get_god(self.civ)
 
 class Team:
+    __slots__ = ("players", "name", "id")
+
     def __init__(self, name, id):
         self.players = []
         self.name = name.decode("utf-8")
@@ -928,32 +1306,336 @@ class Team:
 
 
 class Update:
-    def __init__(self, num, commands, selectedUnits, time):
+    __slots__ = ("commands", "selectedUnits", "time", "num", "loadFlags")
+
+    def __init__(self, num, commands, selectedUnits, time, loadFlags=0):
         self.commands = commands
         self.selectedUnits = selectedUnits
         self.time = time
         self.num = num
+        self.loadFlags = loadFlags
 
     def set_num(self, num):
         self.num = num
 
+def recording_key(filepath):
+    # Size, mtime and hash of the recording. A saved UpdateIndex is only used if all of these match
+    st = os.stat(filepath)
+    digest = hashlib.blake2b(digest_size=16)
+    with open(filepath, "rb") as f:
+        for chunk in iter(lambda: f.read(0x100000), b""):
+            digest.update(chunk)
+    return st.st_size, st.st_mtime_ns, digest.digest()
+
+class SyncData:
+    # Sync values captured while parsing with Rec(capture_sync=True), kept in flat arrays
+    # blocks has two values per sync update: its number of entries and its number of trailing values
+    # entries has six values per entry: first byte, second byte, the u16, the u32 that is only there
+    # when the low nibble of the first byte isn't 5 (0 when it isn't there) and the last two u32s
+    # values has the trailing values of every sync update
+    __slots__ = ("blocks", "entries", "values")
+
+    def __init__(self):
+        self.blocks = array("I")
+        self.entries = array("I")
+        self.values = array("I")
+
+    def __len__(self):
+        return len(self.blocks) // 2
+
+class UpdateIndex:
+    # What Rec.parse finds out about each update, kept in arrays instead of objects
+    # offsets are where the update starts (its loadFlags) in the decompressed recording
+    # start_times is the game time in ms when the update starts, i.e. the sum of the times before it
+    def __init__(self):
+        self.offsets = array("Q")
+        self.load_flags = array("B")
+        self.times = array("I")
+        self.start_times = array("Q")
+        self.command_counts = array("I")
+        self.end_time = 0
+
+    def append(self, offset, loadFlags, time, numCommands):
+        self.offsets.append(offset)
+        self.load_flags.append(loadFlags)
+        self.times.append(time)
+        self.start_times.append(self.end_time)
+        self.command_counts.append(numCommands)
+        self.end_time += time
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def arrays(self):
+        return [self.offsets, self.load_flags, self.times, self.start_times, self.command_counts]
+
+    def save(self, path, key):
+        # Returns False if it couldn't be written (read only folder, disk full), the index is just rebuilt next time
+        size, mtime_ns, digest = key
+        tmp_path = path + ".tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, size, mtime_ns, digest, len(self)))
+                for arr in self.arrays():
+                    f.write(arr.tobytes())
+            os.replace(tmp_path, path)
+        except OSError:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return False
+        return True
+
+    @classmethod
+    def load(cls, path, key):
+        # Returns None if there is no index at path or it was written for a different recording
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except OSError:
+            return None
+        if len(data) < INDEX_HEADER.size:
+            return None
+        magic, version, size, mtime_ns, digest, count = INDEX_HEADER.unpack_from(data)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION or (size, mtime_ns, digest) != key:
+            return None
+        index = cls()
+        pos = INDEX_HEADER.size
+        for arr in index.arrays():
+            n = count * arr.itemsize
+            if pos + n > len(data):
+                return None
+            arr.frombytes(data[pos:pos+n])
+            pos += n
+        index.end_time = sum(index.times)
+        return index
+
+class LazyUpdate(Update):
+    # Update whose commands and selected units are only decoded when they are accessed
+    __slots__ = ("rec", "idx", "decoded")
+
+    def __init__(self, rec, idx):
+        self.rec = rec
+        self.idx = idx
+        self.num = idx + 1
+        self.time = rec.update_index.times[idx]
+        self.loadFlags = rec.update_index.load_flags[idx]
+        self.decoded = None
+
+    def decode(self):
+        if self.decoded is None:
+            if self.rec.update_index.command_counts[self.idx] == 0 and not self.loadFlags & LOAD_FLAGS_SELECTED_UNITS:
+                self.decoded = Update(self.num, [], [], self.time, self.loadFlags)
+            else:
+                self.decoded = self.rec.decode_update(self.idx)
+        return self.decoded
+
+    @property
+    def commands(self):
+        return self.decode().commands
+
+    @property
+    def selectedUnits(self):
+        return self.decode().selectedUnits
+
+class LazyUpdates:
+    # Stands in for the list of updates when parsing with lazy=True
+    def __init__(self, rec):
+        self.rec = rec
+
+    def __len__(self):
+        return len(self.rec.update_index)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [LazyUpdate(self.rec, i) for i in range(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self)
+        if idx < 0 or idx >= len(self):
+            raise IndexError("update index out of range")
+        return LazyUpdate(self.rec, idx)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield LazyUpdate(self.rec, i)
+
+class CommandColumns:
+    # Every command of a parsed game as numpy columns, one row per command
+    # payload_id is whichever of PAYLOAD_FIELDS the command has, -1 if none
+    # position is mBuildingPosition or mTerrainPoint, zero if the command has neither
+    # The recipients of command i are recipients[recipient_offsets[i]:recipient_offsets[i+1]], waypoints likewise
+    PAYLOAD_FIELDS = ("techId", "mProtoUnitId", "protoUnitId", "mUnitId")
+    POSITION_FIELDS = ("mBuildingPosition", "mTerrainPoint")
+
+    def __init__(self, rec):
+        if np is None:
+            raise ImportError("CommandColumns needs numpy")
+        variant = rec.reader.variant
+        update = array("I")
+        time = array("Q")
+        player = array("i")
+        cmd_type = array("h")
+        payload_id = array("q")
+        position = array("I")
+        recipient_offsets = array("Q", [0])
+        recipients = array("I")
+        waypoint_offsets = array("Q", [0])
+        waypoints = array("f")
+
+        counts = rec.update_index.command_counts
+        start_times = rec.update_index.start_times
+        for idx, upd in enumerate(rec.updates):
+            # Lazy updates without commands don't need decoding
+            if counts[idx] == 0:
+                continue
+            for command in upd.commands:
+                if command is None:
+                    continue
+                update.append(idx)
+                time.append(start_times[idx])
+                player.append(command.playerId)
+                cmd_type.append(Commands.registry.number(type(command), variant))
+                for field in self.PAYLOAD_FIELDS:
+                    if hasattr(command, field):
+                        payload_id.append(getattr(command, field))
+                        break
+                else:
+                    payload_id.append(-1)
+                for field in self.POSITION_FIELDS:
+                    if hasattr(command, field):
+                        position.extend(getattr(command, field))
+                        break
+                else:
+                    position.extend((0, 0, 0))
+                recipients.extend(command.mRecipients)
+                recipient_offsets.append(len(recipients))
+                for waypoint in command.waypoints:
+                    waypoints.extend(waypoint)
+                waypoint_offsets.append(len(waypoints) // 3)
+
+        self.update = np.frombuffer(update, dtype=np.uint32)
+        self.time = np.frombuffer(time, dtype=np.uint64)
+        self.player = np.frombuffer(player, dtype=np.int32)
+        self.type = np.frombuffer(cmd_type, dtype=np.int16)
+        self.payload_id = np.frombuffer(payload_id, dtype=np.int64)
+        self.position = np.frombuffer(position, dtype=np.uint32).reshape(-1, 3)
+        self.recipient_offsets = np.frombuffer(recipient_offsets, dtype=np.uint64)
+        self.recipients = np.frombuffer(recipients, dtype=np.uint32)
+        self.waypoint_offsets = np.frombuffer(waypoint_offsets, dtype=np.uint64)
+        self.waypoints = np.frombuffer(waypoints, dtype=np.float32).reshape(-1, 3)
+        self.variant = variant
+        self.game_time = rec.game_time_milliseconds()
+
+    def __len__(self):
+        return len(self.type)
+
+    def of_type(self, cls):
+        # Mask of the rows that are commands of class cls, e.g. columns.payload_id[columns.of_type(Commands.ResearchCommand)]
+        return self.type == Commands.registry.number(cls, self.variant)
+
+    def commands_per_player(self):
+        return np.bincount(self.player[self.player >= 0])
+
+    def actions_per_minute(self):
+        # Indexed by player id
+        minutes = self.game_time / 60000
+        if minutes == 0:
+            return self.commands_per_player() * 0.0
+        return self.commands_per_player() / minutes
+
 class Rec:
-    def __init__(self, filepath):
+    def __init__(self, filepath, stream=False, window=STREAM_WINDOW, header_only=False, capture_sync=False, header_state=None):
+        # capture_sync keeps the sync values of every update in self.sync (a SyncData), they are skipped otherwise
+        # header_state is what header_state() returned for this recording, the file isn't opened then
         self.players = []
         self.updates = []
         self.teams = []
         self.has_comp = False
         self.filepath = filepath
+        self.stream = stream
+        self.window = window
+        self.header_only = header_only
+        self.parsed_header = False
+        self.include = None
+        self.update_index = UpdateIndex()
+        self.sync = SyncData() if capture_sync else None
+        # Found by parse_header
+        self.xml = None
+        self.recordGameMap = None
+        self.map = None
+        self.controlledPlayer = None
+        self.difficulty = None
+        self.header_end = None
+        # See get_game_data
+        self.game_data = None
+
+        if header_state is not None:
+            self.reader = None
+            self.set_header_state(header_state)
+            return
 
         # Create our RcxReader
-        self.reader = RcxReader(filepath)
+        self.reader = self.open_reader()
         self.is_ee = self.reader.is_ee
         self.civ_mgr = CivManager(self.is_ee)
+
+    @classmethod
+    def from_header_state(cls, filepath, state):
+        # Same as Rec(filepath, header_only=True) after parse_header(read_map_script=False), without touching the file
+        # recreate_data opens it later, starting where the updates do
+        return cls(filepath, header_only=True, header_state=state)
+
+    def header_state(self):
+        # What parse_header found, as plain values that json can store
+        positions = {id(player): i for i, player in enumerate(self.players)}
+        return {
+            "is_ee": self.is_ee,
+            "map": self.map,
+            "controlledPlayer": self.controlledPlayer,
+            "difficulty": self.difficulty,
+            "has_comp": self.has_comp,
+            "header_end": self.header_end,
+            "players": [[p.civ, p.team, p.idx, p.name, p.isObserver] for p in self.players],
+            "teams": [[team.name, team.id, [positions[id(p)] for p in team.players]] for team in self.teams],
+        }
+
+    def set_header_state(self, state):
+        self.is_ee = bool(state["is_ee"])
+        self.civ_mgr = CivManager(self.is_ee)
+        self.map = state["map"]
+        self.controlledPlayer = state["controlledPlayer"]
+        self.difficulty = state["difficulty"]
+        self.has_comp = bool(state["has_comp"])
+        self.header_end = state["header_end"]
+        self.players = [Player(civ, team, idx, self.civ_mgr, isObserver=isObserver, name=name)
+            for civ, team, idx, name, isObserver in state["players"]]
+        self.teams = []
+        for name, id, members in state["teams"]:
+            team = Team(name.encode("utf-8"), id)
+            for i in members:
+                team.addPlayer(self.players[i])
+            self.teams.append(team)
+        self.parsed_header = True
+
+    def open_reader(self):
+        # Streaming keeps memory bounded by window, but the recording can then only be read forwards
+        if self.header_only:
+            # Only inflate (and read from disk) what parse_header needs
+            return StreamingRcxReader(self.filepath, HEADER_WINDOW, HEADER_READ_SIZE)
+        if self.stream:
+            reader = StreamingRcxReader(self.filepath, self.window)
+        else:
+            reader = RcxReader(self.filepath)
+        reader.sync = self.sync
+        return reader
         
-        
-    def parse_update(self, updateNum):
+    def parse_update(self, updateNum, include=None):
+        # Commands whose class isn't in include (if given) are skipped and left as None
         selectedUnits = []
         commands = []
+        # Disconnects are always needed to know when to stop
+        decode = None if include is None else include | {Commands.PlayerDisconnectCommand}
 
         loadFlags = self.reader.read_one()
 
@@ -965,18 +1647,18 @@ class Rec:
         numCommands = self.reader.read_num_commands(loadFlags)
         commands = [None] * numCommands
         for i in range(numCommands):
-            commands[i] = self.reader.get_command(loadFlags)
+            commands[i] = self.reader.get_command(loadFlags, decode)
             cmd = commands[i]
             if type(cmd) == Commands.PlayerDisconnectCommand:
-                pass
-            if type(cmd) == Commands.PlayerDisconnectCommand:
+                if include is not None and Commands.PlayerDisconnectCommand not in include:
+                    commands[i] = None
                 # print(cmd, cmd.playerId, cmd.ac, self.players)
                 # print(self.controlledPlayer)
                 # print(self.xml)
                 # print(self.players[cmd.playerId])
                 # print(self.controlledPlayer)
                 if cmd.playerId == self.controlledPlayer:
-                    return Update(updateNum, commands, selectedUnits, upTime), False
+                    return Update(updateNum, commands, selectedUnits, upTime, loadFlags), False
 
         # Read the selected units
         if loadFlags & LOAD_FLAGS_SELECTED_UNITS:
@@ -1000,9 +1682,57 @@ class Rec:
         if self.reader.field_8 < 1:
             # self.validate_read()
             pass
-        return Update(updateNum, commands, selectedUnits, upTime), True
+        return Update(updateNum, commands, selectedUnits, upTime, loadFlags), True
+
+    def index_update(self, updateNum):
+        # Same walk as parse_update, but commands are skipped over instead of decoded
+        # Returns loadFlags, time, number of commands and whether to keep reading
+        reader = self.reader
+        loadFlags = reader.read_one()
+        reader.read_camera(loadFlags)
+        upTime = reader.get_update_time(loadFlags)
+
+        numCommands = reader.read_num_commands(loadFlags)
+        for i in range(numCommands):
+            if reader.read_one() == 0:
+                continue
+            cmd_type = reader.read_four()
+            cls = reader.lookup_command(cmd_type)
+            if cls is Commands.PlayerDisconnectCommand:
+                cmd = cls()
+                cmd.read(reader)
+                if cmd.playerId == self.controlledPlayer:
+                    return loadFlags, upTime, numCommands, False
+            else:
+                cls.skip(reader)
+
+        if loadFlags & LOAD_FLAGS_SELECTED_UNITS:
+            reader.skip(4 * reader.read_one())
+        playerAffCount = reader.read_one()
+        reader.skip(playerAffCount)
+
+        reader.update = updateNum
+        reader.get_sync(loadFlags)
+        return loadFlags, upTime, numCommands, True
+
+    def decode_update(self, idx):
+        # Decodes update idx from the offset recorded by parse. Needs the whole recording in memory
+        if self.stream:
+            raise ValueError("Can't go back to decode updates while streaming")
+        seek = self.reader.seek
+        self.reader.seek = self.update_index.offsets[idx]
+        # The sync values were captured by parse already
+        self.reader.sync = None
+        try:
+            update, keep_read = self.parse_update(idx + 1, self.include)
+        finally:
+            self.reader.seek = seek
+            self.reader.sync = self.sync
+        return update
     
-    def parse_header(self):
+    def parse_header(self, read_map_script=True):
+        # Reads everything up to the first update
+        # read_map_script=False skips over the random map script, self.recordGameMap is None then
         if self.reader.f_54:
             raise NotImplementedError("Game does not start from beginning")
         
@@ -1012,7 +1742,11 @@ class Rec:
         self.xml = lastGameSettingsXml.decode("utf-16")
 
         # read map script (recordGameRandomMap.xs)
-        self.recordGameMap = self.reader.read_file()
+        if read_map_script:
+            self.recordGameMap = self.reader.read_file()
+        else:
+            self.recordGameMap = None
+            self.reader.skip_file()
         
         # Read info about the players (civ, team)
         numPlayers = self.reader.read_four()
@@ -1137,6 +1871,7 @@ class Rec:
                 test2 = self.reader.read_four_s()
                 if test2 > 0x10:
                     print("PL NUM ERR")
+                    # The rest of the header isn't read, header_end stays None so the updates can't be found
                     return
                 
                 if test2 > 0:
@@ -1169,43 +1904,107 @@ class Rec:
             if player.civ != self.civ_mgr.get_nature_idx():
                 if player.name != "":
                     self.teams[player.team-1].addPlayer(player)
+        # Where the updates start
+        self.header_end = self.reader.seek
+        self.parsed_header = True
     
 
-    def parse(self, print_progress=False):
-        self.parse_header()
+    def index_path(self):
+        return self.filepath + INDEX_SUFFIX
+
+    def parse(self, print_progress=False, lazy=False, use_index=False, include=None):
+        # lazy only records where each update is, commands are decoded when Update.commands is used
+        # use_index loads the update index saved by an earlier parse instead of walking the updates,
+        # or saves one after walking them. Updates are then lazy like with lazy=True
+        # include is the Command classes to decode, e.g. (Commands.ResignCommand,). Other commands are
+        # skipped using their length prefixes and are None in Update.commands
+        if self.header_only:
+            raise ValueError("Recording was opened header only")
+        if (lazy or use_index) and self.stream:
+            raise ValueError("Lazy parsing needs the whole recording, it can't be used with stream")
+        if not self.parsed_header:
+            self.parse_header()
+        self.include = None if include is None else frozenset(include)
+        if use_index:
+            key = recording_key(self.filepath)
+            index = UpdateIndex.load(self.index_path(), key)
+            if index is not None:
+                self.update_index = index
+                self.updates = LazyUpdates(self)
+                return
+        if lazy:
+            self.updates = LazyUpdates(self)
         
         # Now we parse all the updates
-        time = 0
+        for offset, loadFlags, upTime, numCommands, update in self.walk_updates(lazy, print_progress, self.include):
+            self.update_index.append(offset, loadFlags, upTime, numCommands)
+            if not lazy:
+                self.updates.append(update)
+        if print_progress:
+            print("Finished reading everything!")
+        if use_index:
+            self.update_index.save(self.index_path(), key)
+
+        # This stuff isn't currently used. this is the reading of the syncBobbers
+        # It happens some time before the updates, but doesn't seem to be important
+        # we now are not reading compressed
+        # just read direct
+        # syncBobberRead = reader.read_four()
+        # for i in range(syncBobberRead):
+        #     syncBobberData = reader.read_four()
+        # now back to compressed at same seek
+
+    def walk_updates(self, lazy=False, print_progress=False, include=None):
+        # Reads every update from the reader's seek on
+        # Yields (offset, loadFlags, time, numCommands, update). update is None when lazy, commands are only skipped then
         for updateNum in range(1,0x1000001):
             pre = self.reader.seek
+            update = None
             try:
-                update, keep_read = self.parse_update(updateNum)
+                if lazy:
+                    loadFlags, upTime, numCommands, keep_read = self.index_update(updateNum)
+                else:
+                    update, keep_read = self.parse_update(updateNum, include)
+                    loadFlags, upTime, numCommands = update.loadFlags, update.time, len(update.commands)
             except Exception as e:
                 print("At offset " + hex(pre) +" and update " + hex(updateNum) + " we had an error.")
                 raise e
-            self.updates.append(update)
+            yield pre, loadFlags, upTime, numCommands, update
             if updateNum % 20000 == 0:
                 if print_progress:
-                    print("Parsing progress: {:.2f}%".format(self.reader.seek * 100 / len(self.reader.decomp)))
-            if len(self.reader.decomp) == self.reader.seek:
+                    print("Parsing progress: {:.2f}%".format(self.reader.seek * 100 / self.reader.size))
+            if self.reader.size == self.reader.seek:
                 break
             if not keep_read:
                 break
             # print(hex(self.reader.seek), hex(updateNum), self.reader.seek-pre, hex(len(self.reader.decomp)))
-            time += update.time
-            # print(self.game_time_formatted(time))
-            # print(self.players)
-        if print_progress:
-            print("Finished reading everything!")
 
-        # This stuff isn't currently used. this is the reading of the syncBobbers
-        # It happens some time before the updates, but doesn't seem to be important
-        # we now are not reading compressed
-        # just read direct
-        # syncBobberRead = reader.read_four()
-        # for i in range(syncBobberRead):
-        #     syncBobberData = reader.read_four()
-        # now back to compressed at same seek
+    def iter_updates(self, include=None):
+        # Decodes and yields (game time, update) one update at a time without keeping them
+        # The update index isn't filled either, time_at, update_at and seek_time need parse
+        # Works with stream=True, so any length of recording can be processed in constant memory
+        # include works like for parse
+        if self.header_only:
+            raise ValueError("Recording was opened header only")
+        if not self.parsed_header:
+            self.parse_header()
+        if include is not None:
+            include = frozenset(include)
+        time = 0
+        for offset, loadFlags, upTime, numCommands, update in self.walk_updates(include=include):
+            yield time, update
+            time += upTime
+
+    def iter_commands(self, include=None):
+        # Yields (game time, player, command) for every command, see iter_updates
+        for time, update in self.iter_updates(include):
+            for command in update.commands:
+                if command is None:
+                    continue
+                yield time, self.command_player(command), command
+
+    def command_player(self, command):
+        return self.players[command.playerId] if command.playerId < len(self.players) else None
 
     def display_by_teams(self):
         print(self.map)
@@ -1242,21 +2041,77 @@ class Rec:
         return ret
     
     def game_time_milliseconds(self):
-        time = 0
-        for update in self.updates:
-            time += update.time
-        return time
+        return self.update_index.end_time
+
+    def to_columns(self):
+        # Numpy columnar copy of the commands, see CommandColumns
+        return CommandColumns(self)
+
+    # The update index keeps when every update starts (the sum of the times before it), so these are
+    # bisections instead of passes over the updates
+    # Only parse fills the index. iter_updates doesn't keep anything, so after it there's nothing to look up
+
+    def time_at(self, idx):
+        # Game time in ms at which update idx starts. idx == len(self.updates) gives the end of the game
+        if idx == len(self.update_index):
+            return self.update_index.end_time
+        return self.update_index.start_times[idx]
+
+    def update_at(self, ms):
+        # Index of the update that is active at game time ms, None if no updates were parsed
+        if not len(self.update_index):
+            return None
+        return max(bisect_right(self.update_index.start_times, ms) - 1, 0)
+
+    def updates_between(self, start_ms, end_ms):
+        # Range of the indexes of the updates starting at or after start_ms and before end_ms
+        start_times = self.update_index.start_times
+        return range(bisect_left(start_times, start_ms), bisect_left(start_times, end_ms))
+
+    def commands_between(self, start_ms, end_ms, include=None):
+        # Yields (game time, player, command) for the commands from start_ms up to end_ms,
+        # e.g. commands_between(3*60000, 5*60000) for 3:00 to 5:00. Only those updates are decoded when lazy
+        # include is Command classes to only give those of
+        if include is not None:
+            include = tuple(include)
+        start_times = self.update_index.start_times
+        for idx in self.updates_between(start_ms, end_ms):
+            time = start_times[idx]
+            for command in self.updates[idx].commands:
+                if command is None:
+                    continue
+                if include is not None and not isinstance(command, include):
+                    continue
+                yield time, self.command_player(command), command
+
+    def seek_time(self, ms):
+        # Moves the reader to the update active at game time ms and returns that update
+        idx = self.update_at(ms)
+        if idx is None:
+            raise ValueError("No updates parsed, call parse first")
+        self.reader.seek = self.update_index.offsets[idx]
+        return self.updates[idx]
 
     def print_checked(self, input, print_info):
         if print_info:
             print(input)
 
+    def get_game_data(self):
+        # EE recordings use AOM_PATH and AOM_VERSION, AoT ones AOT_PATH and AOT_VERSION
+        # AoT recordings fall back to the EE data when there's no complete AoT install at AOT_PATH
+        # EE patches aren't told apart, every EE recording gets AOM_VERSION. Found once per Rec
+        if self.game_data is None:
+            if self.is_ee or not all(os.path.exists(path) for path in game_data_paths(AOT_PATH, AOT_VERSION)):
+                self.game_data = get_game_data()
+            else:
+                self.game_data = get_game_data(AOT_PATH, AOT_VERSION)
+        return self.game_data
+
     def analyze_updates(self, print_info=False):
-        ttdatabase = TechTreeDatabase()
-        pudatabase = ProtoUnitDatabase()
-        time = 0
-        i = 0
-        for update in self.updates:
+        # Game data is only needed for names, so it's only looked up when they are printed
+        start_times = self.update_index.start_times
+        for i, update in enumerate(self.updates):
+            time = start_times[i]
             commands = update.commands
             for command in commands:
                 # if command.resigningPlayerId == 3:
@@ -1266,17 +2121,18 @@ class Rec:
                     # if not self.players[command.resigningPlayerId].isObserver:
                     self.print_checked(str(self.players[command.resigningPlayerId]) + " has resigned", print_info)
                 elif type(command) == Commands.ResearchCommand:
-                    self.print_checked(str(self.players[command.playerId]) + " clicked " + ttdatabase.get_tech(command.techId)
-                     + " at " + self.game_time_formatted(time), print_info)
+                    if print_info:
+                        self.print_checked(str(self.players[command.playerId]) + " clicked " + self.get_game_data().tech_tree.get_tech(command.techId)
+                         + " at " + self.game_time_formatted(time), print_info)
                 elif type(command) == Commands.PlayerDisconnectCommand:
                     self.print_checked(str(self.players[command.playerId]) + " has disconnected", print_info)
                 elif type(command) == Commands.BuildCommand:
                     if False:
-                        self.print_checked(str(self.players[command.playerId]) + " has built " + pudatabase.get_displayname(command.protoUnitId)
+                        self.print_checked(str(self.players[command.playerId]) + " has built " + self.get_game_data().proto_units.get_displayname(command.protoUnitId)
                         + " at " + self.game_time_formatted(time), print_info)
                 elif type(command) == Commands.TrainCommand:
                     if False:
-                        self.print_checked(str(self.players[command.playerId]) + " tried training " + pudatabase.get_displayname(command.mProtoUnitId)
+                        self.print_checked(str(self.players[command.playerId]) + " tried training " + self.get_game_data().proto_units.get_displayname(command.mProtoUnitId)
                         + " at " + self.game_time_formatted(time), print_info)
                 # elif type(command) == Commands.WorkCommand:
                 #     print(command.playerId)
@@ -1293,9 +2149,7 @@ class Rec:
                     #     if command.playerId == 2:
                     #         print(command, self.game_time_formatted(time), self.players[command.playerId])
                     #         if type(command) == Commands.BuildCommand:
-                    #             print(pudatabase.get_displayname(command.protoUnitId))
-            time += update.time
-            i += 1
+                    #             print(self.get_game_data().proto_units.get_displayname(command.protoUnitId))
 
     def game_time_formatted(self, ms=None):
         if ms is None:
@@ -1329,81 +2183,113 @@ class Rec:
         return losingTeams
     
     def clear_data(self):
-        self.reader.decomp = b""
+        if self.reader is not None:
+            self.reader.close()
     
     def recreate_data(self):
-        seek = self.reader.seek
-        self.reader = RcxReader(self.filepath)
+        # Opens a full reader where the last one stopped, so a header only rec can go on to parse the updates
+        # Recs from a HeaderCache have no reader until this is called, they start where the updates do
+        if self.reader is None and self.header_end is None:
+            raise ValueError("Header wasn't fully read, updates can't be found")
+        seek = self.reader.seek if self.reader is not None else self.header_end
+        self.header_only = False
+        self.reader = self.open_reader()
         self.reader.seek = seek
             
-def analyze_group(folderpath, is_ee=True):
+class AnalyzeTimeout(Exception):
+    pass
+
+def raise_analyze_timeout(signum, frame):
+    raise AnalyzeTimeout("Timed out")
+
+def analyze_file(filepath, timeout=ANALYZE_TIMEOUT):
+    # Analyzes one recording for analyze_group, normally in a worker process
+    # Returns what it printed, wins and losses per god as Counters, and the error or None
+    # timeout is in seconds, it uses SIGALRM so it only works where that exists
+    output = io.StringIO()
+    god_wins = Counter()
+    god_losses = Counter()
+    error = None
+    use_alarm = timeout and hasattr(signal, "SIGALRM")
+    if use_alarm:
+        old_handler = signal.signal(signal.SIGALRM, raise_analyze_timeout)
+        signal.alarm(timeout)
+    try:
+        with redirect_stdout(output):
+            print(os.path.basename(filepath))
+            rec = Rec(filepath)
+            rec.parse(include=OUTCOME_COMMANDS)
+            rec.analyze_updates()
+            rec.display_by_teams()
+            # rec.print_winner()
+            
+            winning_team = rec.get_winning_team()
+            losing_teams = rec.get_losing_teams()
+            if winning_team is None:
+                print("No winning team ")
+            elif len(losing_teams) < 1:
+                print("No losing team")
+            else:
+                for player in winning_team.players:
+                    god_wins[player.get_civ_str()] += 1
+                for losing_team in losing_teams:
+                    for player in losing_team.players:
+                        god_losses[player.get_civ_str()] += 1
+    except Exception as e:
+        error = str(e)
+        print(e, os.path.basename(filepath) + " was here", file=output)
+    finally:
+        if use_alarm:
+            signal.alarm(0)
+            signal.signal(signal.SIGALRM, old_handler)
+    return output.getvalue(), god_wins, god_losses, error
+
+def analyze_alone(filepath, timeout=ANALYZE_TIMEOUT):
+    # analyze_file in a process of its own, so if it dies only this recording is lost
+    with ProcessPoolExecutor(1) as pool:
+        try:
+            return pool.submit(analyze_file, filepath, timeout).result()
+        except BrokenProcessPool:
+            return "", Counter(), Counter(), "Worker process died"
+
+def analyze_files(paths, jobs=None, timeout=ANALYZE_TIMEOUT):
+    # Yields what analyze_file returns for each of paths, in order, from a process pool of jobs processes
+    # A worker that dies (crash, killed for memory) breaks the pool, and everything not finished yet fails with it.
+    # Those are analyzed again one at a time, so only the recording that kills its worker is reported as an error
+    with ProcessPoolExecutor(jobs) as pool:
+        futures = [pool.submit(analyze_file, path, timeout) for path in paths]
+        for path, future in zip(paths, futures):
+            try:
+                result = future.result()
+            except BrokenProcessPool:
+                result = analyze_alone(path, timeout)
+            yield result
+
+def analyze_group(folderpath, is_ee=True, jobs=None, timeout=ANALYZE_TIMEOUT):
+    # Every recording is analyzed on its own by analyze_file in a process pool of jobs processes
+    # Results are merged in file name order, so the output is the same for any number of jobs
     errors = {}
-    god_wins = {}
-    god_losses = {}
+    god_wins = Counter()
+    god_losses = Counter()
     folderpath += os.sep
 
-
-    duplicate_test = {}
-    for file in os.listdir(folderpath):
-        if file.endswith(".rcx"):
-            try:
-                print(file)
-                rec = Rec(folderpath + file)
-                rec.parse()
-                rec.analyze_updates()
-                rec.display_by_teams()
-                # rec.print_winner()
-                
-                winning_team = rec.get_winning_team()
-                losing_teams = rec.get_losing_teams()
-                if winning_team is None:
-                    print("No winning team ")
-                    continue
-                if len(losing_teams) < 1:
-                    print("No losing team")
-                    continue
-                if winning_team is not None:
-                    for player in winning_team.players:
-                        winning_civ = player.get_civ_str()
-                        if winning_civ in god_wins:
-                            god_wins[winning_civ] += 1
-                        else:
-                            god_wins[winning_civ] = 1
-                    for losing_team in losing_teams:
-                        for player in losing_team.players:
-                            losing_civ = player.get_civ_str()
-                            if losing_civ in god_losses:
-                                god_losses[losing_civ] += 1
-                            else:
-                                god_losses[losing_civ] = 1
-                
-                # if str(winning_team) in duplicate_test:
-                #     losers = duplicate_test[str(winning_team)]
-                    
-                #     for loser in losers:
-                #         losing_team_str = loser[0]
-                #         lose_file = loser[1]
-                #         # print(str(losing_team), losing_team_str + " A ")
-                #         if str(losing_team) == losing_team_str:
-                #             print("Duplicate game: " + lose_file + " == " + file)
-                #             continue
-                #     losers.append([str(losing_team), file])
-                # else:
-                #     duplicate_test[str(winning_team)] = [[str(losing_team),file]]
-                # print(str(winning_team), str(losing_team))
-                    
-                # print(winning_team,"beat", losing_team)
-                # else:
-                #     print("Error: " + file + " has no winner")
-            except Exception as e:
-                print(e, file + " was here")
-                e = str(e)
-                if e in errors:
-                    abc = errors[e]
-                    abc[0] += 1
-                    abc[1].append(file)
-                else:
-                    errors[e] = [1, [file]] 
+    files = sorted(file for file in os.listdir(folderpath) if file.endswith(".rcx"))
+    paths = [folderpath + file for file in files]
+    if jobs == 1:
+        results = map(analyze_file, paths, [timeout] * len(paths))
+    else:
+        results = analyze_files(paths, jobs, timeout)
+    for file, (output, wins, losses, error) in zip(files, results):
+        print(output, end="")
+        god_wins.update(wins)
+        god_losses.update(losses)
+        if error is not None:
+            if error in errors:
+                abc = errors[error]
+                abc[0] += 1
+                abc[1].append(file)
+            else:
+                errors[error] = [1, [file]]
     all_gods = ["Zeus", "Poseidon", "Hades", "Isis", "Ra", "Set", "Odin", "Thor", "Loki", "Kronos", "Oranos", "Gaia", "Fu Xi", "Nu Wa", "Shennong"]
     for god in all_gods:
         wins = 0
@@ -1421,63 +2307,158 @@ def analyze_group(folderpath, is_ee=True):
     num_games2 = sum([god_losses[x] for x in ["Zeus", "Poseidon", "Hades", "Isis", "Ra", "Set", "Odin", "Thor", "Loki", "Kronos", "Oranos", "Gaia"]])
     print(num_games2, num_games)
 
-def parse_all_headers(base):
+class HeaderCache:
+    # What parse_header found for each recording, in SQLite, so unchanged recordings aren't parsed again
+    # A row is only used while the file's size and mtime and PARSER_VERSION still match. Failures are cached too
+    # Rows are keyed by absolute path, so one cache can hold recordings from any number of folders
+    # Past opening it, database errors (locked, read only, corrupt file) only mean a recording isn't cached
+    def __init__(self, path):
+        self.read_only = False
+        self.db = sqlite3.connect(path)
+        try:
+            self.db.execute("CREATE TABLE IF NOT EXISTS headers (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, "
+                "version INTEGER, error TEXT, is_ee INTEGER, map TEXT, controlled_player INTEGER, difficulty INTEGER, "
+                "has_comp INTEGER, players TEXT, teams TEXT, header_end INTEGER)")
+        except sqlite3.Error:
+            self.db.close()
+            raise
+
+    def close(self):
+        try:
+            self.db.commit()
+        except sqlite3.Error:
+            pass
+        self.db.close()
+
+    def get(self, filepath, st):
+        # Returns None if filepath isn't cached for this st (an os.stat result), else (rec, error)
+        try:
+            row = self.db.execute("SELECT size, mtime_ns, version, error, is_ee, map, controlled_player, difficulty, "
+                "has_comp, players, teams, header_end FROM headers WHERE path = ?", (os.path.abspath(filepath),)).fetchone()
+        except sqlite3.Error:
+            return None
+        if row is None:
+            return None
+        size, mtime_ns, version, error, is_ee, map, controlledPlayer, difficulty, has_comp, players, teams, header_end = row
+        if (size, mtime_ns, version) != (st.st_size, st.st_mtime_ns, PARSER_VERSION):
+            return None
+        if error is not None:
+            return None, error
+
+        state = {"is_ee": is_ee, "map": map, "controlledPlayer": controlledPlayer, "difficulty": difficulty,
+            "has_comp": has_comp, "header_end": header_end, "players": json.loads(players), "teams": json.loads(teams)}
+        return Rec.from_header_state(filepath, state), None
+
+    def put(self, filepath, st, rec=None, error=None):
+        # A cache that can't be written to (read only file or folder) is still read from, nothing new is added
+        if self.read_only:
+            return
+        try:
+            self.insert(filepath, st, rec, error)
+        except sqlite3.Error:
+            self.read_only = True
+
+    def insert(self, filepath, st, rec, error):
+        if error is not None:
+            self.db.execute("INSERT OR REPLACE INTO headers (path, size, mtime_ns, version, error) VALUES (?, ?, ?, ?, ?)",
+                (os.path.abspath(filepath), st.st_size, st.st_mtime_ns, PARSER_VERSION, error))
+            return
+        state = rec.header_state()
+        self.db.execute("INSERT OR REPLACE INTO headers VALUES (?, ?, ?, ?, NULL, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (os.path.abspath(filepath), st.st_size, st.st_mtime_ns, PARSER_VERSION, int(state["is_ee"]), state["map"],
+            state["controlledPlayer"], state["difficulty"], int(state["has_comp"]), json.dumps(state["players"]),
+            json.dumps(state["teams"]), state["header_end"]))
+
+def open_header_cache(path=None):
+    # Returns a HeaderCache at path (HEADER_CACHE_PATH by default), or None if it can't be opened there
+    if path is None:
+        path = HEADER_CACHE_PATH
+    try:
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        return HeaderCache(path)
+    except (sqlite3.Error, OSError):
+        return None
+
+def parse_all_headers(base, cache_path=None, use_cache=True):
+    # Headers come from a HeaderCache at cache_path (HEADER_CACHE_PATH by default) when the recording
+    # hasn't changed. Only new or changed recordings are parsed, and then added to the cache
+    # Without a usable cache there it works as with use_cache=False
     recs = []
     import traceback
-    for file in os.listdir(base):
-        if file.endswith(".rcx"):
-            try:
-                rec = Rec(base + file)
-                rec.parse_header()
-                recs.append(rec)
-                rec.clear_data()
-                # f.write(file + " worked\n")
-            except Exception as e:
-                print(file + "  " + str(e))
-                # f.write(file + " " + str(e))
-                # f.write(traceback.format_exc())
+    cache = None
+    if use_cache:
+        cache = open_header_cache(cache_path)
+    try:
+        for file in sorted(os.listdir(base)):
+            if file.endswith(".rcx"):
+                filepath = base + file
+                st = os.stat(filepath)
+                cached = cache.get(filepath, st) if cache is not None else None
+                if cached is not None:
+                    rec, error = cached
+                    if error is None:
+                        recs.append(rec)
+                    else:
+                        print(file + "  " + error)
+                    continue
+                try:
+                    rec = Rec(filepath, header_only=True)
+                    rec.parse_header(read_map_script=False)
+                    recs.append(rec)
+                    rec.clear_data()
+                    if cache is not None:
+                        cache.put(filepath, st, rec)
+                    # f.write(file + " worked\n")
+                except Exception as e:
+                    print(file + "  " + str(e))
+                    if cache is not None:
+                        cache.put(filepath, st, error=str(e))
+                    # f.write(file + " " + str(e))
+                    # f.write(traceback.format_exc())
+    finally:
+        if cache is not None:
+            cache.close()
     return recs
 
-def filter_by_player(recs, player_name, god="*", opposing_player_name="*", opposing_god="*"):
-    ret_recs = []
-    for rec in recs:
-        found_player = False
+def matches_player(rec, player_name, god="*", opposing_player_name="*", opposing_god="*"):
+    found_player = False
+    for team in rec.teams:
+        if team.is_observing_team():
+            continue
+        if team.has_player(player_name):
+            if god == "*" or rec.civ_mgr.get_god(team.get_player(player_name).civ) == god:
+                found_player = True
+
+
+    if found_player:
         for team in rec.teams:
-            if team.is_observing_team():
+            if team.is_observing_team() or team.has_player(player_name):
                 continue
-            if team.has_player(player_name):
-                if god == "*" or rec.civ_mgr.get_god(team.get_player(player_name).civ) == god:
-                    found_player = True
+            # Check opposing player
+            if opposing_player_name=="*" or team.has_player(opposing_player_name):
+                for player in team.players:
+                    # Check opposing god
+                    if opposing_god == "*" or rec.civ_mgr.get_god(player.civ) == opposing_god:
+                        return True
+    return False
 
-
-        if found_player:
-            found_opponent = False 
-            for team in rec.teams:
-                if team.is_observing_team() or team.has_player(player_name):
-                    continue
-                # Check opposing player
-                if opposing_player_name=="*" or team.has_player(opposing_player_name):
-                    for player in team.players:
-                        # Check opposing god
-                        if opposing_god == "*" or rec.civ_mgr.get_god(player.civ) == opposing_god:
-                            found_opponent = True
-                        
-
-            if found_opponent:
-                ret_recs.append(rec)
+def filter_by_player(recs, player_name, god="*", opposing_player_name="*", opposing_god="*"):
+    ret_recs = []
+    for rec in recs:
+        if matches_player(rec, player_name, god, opposing_player_name, opposing_god):
+            ret_recs.append(rec)
     return ret_recs
 
+def team_sizes(rec):
+    # Sorted sizes of the teams that aren't observing, (1, 1) for a 1v1
+    return tuple(sorted(len(team.players) for team in rec.teams if not team.is_observing_team()))
+
 def filter_by_1v1s(recs):
     ret_recs =[]
     for rec in recs:
-        team_count = 0
-        bad_player_count = False
-        for team in rec.teams:
-            if not team.is_observing_team():
-                team_count += 1
-                if len(team.players) != 1:
-                    bad_player_count = True
-        if team_count == 2 and not bad_player_count:
+        if team_sizes(rec) == (1, 1):
             ret_recs.append(rec) 
     return ret_recs
 
@@ -1488,6 +2469,78 @@ def filter_by_map(recs, map="*"):
             ret_recs.append(rec)
     return ret_recs
 
+class CorpusIndex:
+    # Inverted indexes over parsed headers, so the filters above don't have to look at every rec
+    # A query intersects the sets for what it asks for, smallest first. Player queries are then checked
+    # exactly with matches_player on what is left, so the results are the same as the filters give
+    def __init__(self, recs=()):
+        self.recs = []
+        self.by_map = {}
+        self.by_team_sizes = {}
+        self.by_player = {}
+        self.by_player_god = {}
+        self.by_god = {}
+        for rec in recs:
+            self.add(rec)
+
+    def __len__(self):
+        return len(self.recs)
+
+    def add(self, rec):
+        # Returns the id of rec in the index
+        rec_id = len(self.recs)
+        self.recs.append(rec)
+        self.by_map.setdefault(rec.map, set()).add(rec_id)
+        self.by_team_sizes.setdefault(team_sizes(rec), set()).add(rec_id)
+        for team in rec.teams:
+            if team.is_observing_team():
+                continue
+            for player in team.players:
+                god = rec.civ_mgr.get_god(player.civ)
+                self.by_god.setdefault(god, set()).add(rec_id)
+                self.by_player.setdefault(player.name, set()).add(rec_id)
+                # A filter looks at the first player on a team with the name
+                if team.get_player(player.name) is player:
+                    self.by_player_god.setdefault((player.name, god), set()).add(rec_id)
+        return rec_id
+
+    def query(self, player_name="*", god="*", opposing_player_name="*", opposing_god="*", map="*", sizes=None):
+        # Recs matching all of filter_by_player, filter_by_map and (if sizes is given) the team sizes, e.g. (1, 1)
+        # or (2, 2). They come back in the order they were added
+        empty = set()
+        candidates = []
+        if map != "*":
+            candidates.append(self.by_map.get(map, empty))
+        if sizes is not None:
+            candidates.append(self.by_team_sizes.get(tuple(sorted(sizes)), empty))
+        if player_name != "*":
+            if god == "*":
+                candidates.append(self.by_player.get(player_name, empty))
+            else:
+                candidates.append(self.by_player_god.get((player_name, god), empty))
+            if opposing_player_name != "*":
+                candidates.append(self.by_player.get(opposing_player_name, empty))
+            if opposing_god != "*":
+                candidates.append(self.by_god.get(opposing_god, empty))
+        elif opposing_player_name != "*" or opposing_god != "*":
+            raise ValueError("Opponents need a player_name")
+        elif god != "*":
+            # Without a player_name, any player (not an observer) with god matches
+            candidates.append(self.by_god.get(god, empty))
+
+        if candidates:
+            candidates.sort(key=len)
+            ids = candidates[0].intersection(*candidates[1:])
+        else:
+            ids = range(len(self.recs))
+        ret_recs = []
+        for rec_id in sorted(ids):
+            rec = self.recs[rec_id]
+            if player_name != "*" and not matches_player(rec, player_name, god, opposing_player_name, opposing_god):
+                continue
+            ret_recs.append(rec)
+        return ret_recs
+
 def write_headers(recs, file=None):
     if file is not None:
         with open(file, "w") as f:
@@ -1500,10 +2553,11 @@ def write_headers(recs, file=None):
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('filename', nargs="?")
+    parser.add_argument('--stream', action="store_true", help="Inflate the recording as it is parsed to bound memory use")
     args = parser.parse_args()
     # analyze_group("/mnt/c/Program Files (x86)/Steam/steamapps/common/Age of Mythology/savegame")
     if args.filename is not None:
-        rec = Rec(args.filename)
+        rec = Rec(args.filename, stream=args.stream)
         rec.parse(print_progress=True)
         rec.analyze_updates(print_info=True)
         rec.display_by_teams()
@@ -1515,9 +2569,8 @@ def main():
         if not os.path.exists(savegame_path):
             savegame_path = "C:\\Program Files (x86)\\Steam\\steamapps\\common\\Age of Mythology\\savegame\\"
         recs = parse_all_headers(savegame_path)
-        recs = filter_by_1v1s(recs)
-        recs = filter_by_player(recs,"Kido", god="Set", opposing_god="*")
-        recs = filter_by_map(recs, "*")
+        index = CorpusIndex(recs)
+        recs = index.query("Kido", god="Set", opposing_god="*", map="*", sizes=(1, 1))
         write_headers(recs, "recs.txt")
 
     # # rec = Rec("3_ppl_1v1_obs_is_titled_as_player_in_program.rcx")
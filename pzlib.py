@@ -0,0 +1,87 @@
+import io
+import os
+import struct
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# Parallel zlib compression in the style of pigz.
+# The input is cut into chunks that are deflated on their own in a thread pool (zlib releases the GIL).
+# Each chunk is primed with the 32KB of input in front of it, so the ratio stays close to a single stream,
+# and is ended with a sync flush so the raw deflate chunks can just be put one after another.
+# A zlib header and the Adler-32 of all the input around them makes it one normal zlib stream.
+
+CHUNK_SIZE = 0x20000
+WINDOW_SIZE = 0x8000
+
+def zlib_header(level):
+    # CMF is deflate with a 32KB window, FLEVEL in FLG only tells how hard the compressor tried
+    if level == -1:
+        level = 6
+    if level < 2:
+        flevel = 0
+    elif level < 6:
+        flevel = 1
+    elif level == 6:
+        flevel = 2
+    else:
+        flevel = 3
+    cmf = 0x78
+    flg = flevel << 6
+    flg += 31 - (cmf * 256 + flg) % 31
+    return bytes((cmf, flg))
+
+def deflate_chunk(chunk, zdict, level, last):
+    # Negative wbits gives raw deflate without a header or checksum
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15, zlib.DEF_MEM_LEVEL, zlib.Z_DEFAULT_STRATEGY, zdict)
+    out = compressor.compress(chunk)
+    return out + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+def chunks_of(buffers, chunk_size):
+    # Yields (chunk, the 32KB before it, is last) over all of buffers as if they were one
+    buffers = [memoryview(b) for b in buffers if len(b)]
+    window = b""
+    for i, buf in enumerate(buffers):
+        for start in range(0, len(buf), chunk_size):
+            chunk = buf[start:start+chunk_size]
+            last = i == len(buffers) - 1 and start + chunk_size >= len(buf)
+            yield chunk, window, last
+            window = (window + bytes(chunk[-WINDOW_SIZE:]))[-WINDOW_SIZE:]
+
+def compress_to(f, buffers, level=-1, threads=None, chunk_size=CHUNK_SIZE):
+    # Writes buffers, one after another, to the file f as a single zlib stream. Returns how many bytes were written
+    if threads is None:
+        threads = os.cpu_count() or 1
+    header = zlib_header(level)
+    f.write(header)
+    written = len(header)
+    adler = 1
+    empty = True
+    with ThreadPoolExecutor(threads) as pool:
+        # Only keep a few chunks per thread in flight, so memory doesn't grow with the input
+        pending = deque()
+        for chunk, zdict, last in chunks_of(buffers, chunk_size):
+            empty = False
+            adler = zlib.adler32(chunk, adler)
+            pending.append(pool.submit(deflate_chunk, chunk, zdict, level, last))
+            if len(pending) >= 2 * threads:
+                data = pending.popleft().result()
+                f.write(data)
+                written += len(data)
+        for job in pending:
+            data = job.result()
+            f.write(data)
+            written += len(data)
+    if empty:
+        # Nothing to compress, but the stream still needs a final block
+        data = deflate_chunk(b"", b"", level, True)
+        f.write(data)
+        written += len(data)
+    f.write(struct.pack(">I", adler))
+    return written + 4
+
+def compress(data, level=-1, threads=None, chunk_size=CHUNK_SIZE):
+    # Same as zlib.compress, but in parallel
+    out = io.BytesIO()
+    compress_to(out, [data], level, threads, chunk_size)
+    return out.getvalue()
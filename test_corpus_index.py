@@ -0,0 +1,53 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import parser as Parser
+
+ZEUS = 0
+SET = 5
+
+def make_rec(name, map, teams):
+    # teams is a list of [(player name, civ), ...], one list per team
+    players = []
+    team_state = []
+    for team_id, team in enumerate(teams, 1):
+        members = []
+        for player_name, civ in team:
+            members.append(len(players))
+            players.append([civ, team_id, len(players), player_name, False])
+        team_state.append(["Team " + str(team_id), team_id, members])
+    state = {"is_ee": True, "map": map, "controlledPlayer": 1, "difficulty": 0, "has_comp": False,
+        "header_end": None, "players": players, "teams": team_state}
+    return Parser.Rec.from_header_state(name, state)
+
+class CorpusIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.recs = [
+            make_rec("a.rcx", "Mediterranean", [[("Kido", SET)], [("Alice", ZEUS)]]),
+            make_rec("b.rcx", "Oasis", [[("Kido", ZEUS)], [("Bob", ZEUS)]]),
+            make_rec("c.rcx", "Oasis", [[("Alice", ZEUS)], [("Bob", ZEUS)]]),
+        ]
+        self.index = Parser.CorpusIndex(self.recs)
+
+    def names(self, recs):
+        return [rec.filepath for rec in recs]
+
+    def test_god_without_player(self):
+        self.assertEqual(self.names(self.index.query(god="Set")), ["a.rcx"])
+        self.assertEqual(self.names(self.index.query(god="Zeus")), ["a.rcx", "b.rcx", "c.rcx"])
+        self.assertEqual(self.names(self.index.query(god="Zeus", map="Oasis")), ["b.rcx", "c.rcx"])
+        self.assertEqual(self.index.query(god="Loki"), [])
+
+    def test_opponent_without_player(self):
+        with self.assertRaises(ValueError):
+            self.index.query(opposing_god="Zeus")
+
+    def test_same_as_filters(self):
+        for god in ("*", "Set", "Zeus"):
+            expected = Parser.filter_by_player(self.recs, "Kido", god, "*", "Zeus")
+            self.assertEqual(self.index.query("Kido", god=god, opposing_god="Zeus"), expected)
+
+if __name__ == "__main__":
+    unittest.main()